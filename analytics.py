@@ -0,0 +1,97 @@
+from collections import namedtuple
+from datetime import datetime
+import os
+
+import numpy as np
+
+from cache import LRUCache
+from model import get_execution_history, get_leaderboard_activities, get_leaderboard_score, get_leaderboard_version
+
+
+DAYS_PER_WEEK = 7
+DAYS_PER_MONTH = 365.25 / 12
+
+# Stats of one activity, overall (user_id is None) or of one participant
+ExecutionStats = namedtuple('ExecutionStats', ['activity_id', 'user_id', 'executions', 'last_user_id', 'last_time',
+                                               'mean_interval_days', 'per_week', 'per_month'])
+ActivityStats = namedtuple('ActivityStats', ['activity_id', 'name', 'overall', 'per_user'])
+
+# Keyed by (leaderboard_id, leaderboard version), so stats live until the next write
+stats_cache = LRUCache(maxsize=int(os.environ.get('STATS_CACHE_SIZE', 256)),
+                       ttl=int(os.environ.get('STATS_CACHE_TTL', 3600)))
+
+
+def group_stats(keys, users, times, now):
+    """
+    Per group of equal keys: number of executions, user and time of the last one,
+    mean days between executions (NaN for a single execution) and executions
+    per week and month since the first one (at least a day).
+    Returns tuple of arrays ordered by key, keys first
+    """
+    order = np.lexsort((times, keys))
+    keys, users, times = keys[order], users[order], times[order]
+    groups, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    ends = starts + counts - 1
+
+    day = np.timedelta64(1, 'D')
+    first, last = times[starts], times[ends]
+    # Mean of consecutive intervals is the whole span over the number of intervals
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_interval = np.where(counts > 1, (last - first) / day / (counts - 1), np.nan)
+    active_days = np.maximum((now - first) / day, 1.0)
+    per_day = counts / active_days
+    return groups, counts, users[ends], last, mean_interval, per_day * DAYS_PER_WEEK, per_day * DAYS_PER_MONTH
+
+
+def compute_stats(activity_ids, user_ids, times, now=None):
+    """
+    Returns dict activity_id -> (overall ExecutionStats, list of per participant ExecutionStats)
+    from columns of the execution history
+    """
+    if not len(activity_ids):
+        return {}
+    activity_ids = np.asarray(activity_ids, dtype=np.int64)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    times = np.asarray(times, dtype='datetime64[s]')
+    now = np.datetime64(now or datetime.utcnow(), 's')
+
+    stats = {}
+    for row in zip(*group_stats(activity_ids, user_ids, times, now)):
+        activity_id, executions, last_user_id, last_time, mean_interval, per_week, per_month = row
+        stats[int(activity_id)] = (ExecutionStats(int(activity_id), None, int(executions), int(last_user_id),
+                                                  last_time.astype(datetime), float(mean_interval),
+                                                  float(per_week), float(per_month)), [])
+
+    # One group per (activity, participant)
+    users, user_index = np.unique(user_ids, return_inverse=True)
+    pair_keys = activity_ids * len(users) + user_index
+    for row in zip(*group_stats(pair_keys, user_ids, times, now)):
+        key, executions, last_user_id, last_time, mean_interval, per_week, per_month = row
+        activity_id = int(key) // len(users)
+        stats[activity_id][1].append(ExecutionStats(activity_id, int(last_user_id), int(executions), int(last_user_id),
+                                                    last_time.astype(datetime), float(mean_interval),
+                                                    float(per_week), float(per_month)))
+    for _, per_user in stats.values():
+        per_user.sort(key=lambda user_stats: user_stats.executions, reverse=True)
+    return stats
+
+
+def get_activity_stats(leaderboard_id:int):
+    """
+    Returns list of ActivityStats of the chat, most executed first. Served from stats_cache
+    """
+    key = (leaderboard_id, get_leaderboard_version(leaderboard_id))
+    return stats_cache.get_or_load(key, lambda: _load_activity_stats(leaderboard_id))
+
+def _load_activity_stats(leaderboard_id:int):
+    stats = compute_stats(*get_execution_history(leaderboard_id=leaderboard_id))
+    result = [ActivityStats(activity.id, activity.activity_name, *stats[activity.id])
+              for activity in get_leaderboard_activities(leaderboard_id=leaderboard_id) if activity.id in stats]
+    result.sort(key=lambda activity_stats: activity_stats.overall.executions, reverse=True)
+    return result
+
+def get_user_names(leaderboard_id:int):
+    """
+    Returns dict user_id -> name of the chat participants
+    """
+    return {row['user_id']: row['name'] for row in get_leaderboard_score(leaderboard_id=leaderboard_id)}
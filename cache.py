@@ -0,0 +1,185 @@
+from collections import OrderedDict, deque
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with TTL and hit/miss counters
+    """
+
+    def __init__(self, maxsize:int=1024, ttl:float=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Bumped on invalidation, so a load started before a write is not cached
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation:int=None):
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns cached value or value returned by loader()
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            generation = self._generations.get(key, 0)
+        value = loader()
+        self.set(key, value, generation=generation)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class VersionCounter:
+    """
+    Monotonic version per key. Bumped by writes, compared by readers
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+class RingBuffers:
+    """
+    Bounded deque of the most recent items per key, newest first. LRU over `maxkeys` keys.
+
+    A key is warm after fill() with items loaded from the database. push() and remove()
+    change only warm keys, a fill started before them is not stored. Generations are kept
+    only for keys with a load in flight, so memory is bounded by `maxkeys` and loads.
+    """
+
+    def __init__(self, size:int=10, maxkeys:int=10000):
+        self.size = size
+        self.maxkeys = maxkeys
+        self.hits = 0
+        self.misses = 0
+        self._buffers = OrderedDict()
+        # key -> [generation, number of loads in flight] of keys being loaded
+        self._loading = {}
+        # Bumped by invalidate_where, drops fills of every key in flight
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns tuple of items or None if key is cold
+        """
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self._buffers.move_to_end(key)
+            self.hits += 1
+            return tuple(buffer)
+
+    def generation(self, key):
+        """
+        Start a load of the key. Must be followed by fill(), with items None if the load failed
+        """
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[1] += 1
+            return loading[0], self._epoch
+
+    def fill(self, key, items, generation):
+        with self._lock:
+            loading = self._loading[key]
+            current = (loading[0], self._epoch)
+            loading[1] -= 1
+            if not loading[1]:
+                del self._loading[key]
+            if items is None or generation != current:
+                return
+            self._buffers[key] = deque(items, maxlen=self.size)
+            self._buffers.move_to_end(key)
+            while len(self._buffers) > self.maxkeys:
+                self._buffers.popitem(last=False)
+
+    def push(self, key, item):
+        with self._lock:
+            self._changed(key)
+            buffer = self._buffers.get(key)
+            if buffer is not None:
+                buffer.appendleft(item)
+
+    def remove(self, key, match):
+        """
+        Remove items for which match(item) is true
+        """
+        with self._lock:
+            self._changed(key)
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                return
+            kept = [item for item in buffer if not match(item)]
+            if len(kept) < len(buffer) == self.size:
+                # Older items that should move up are only in the database
+                del self._buffers[key]
+            else:
+                self._buffers[key] = deque(kept, maxlen=self.size)
+
+    def _changed(self, key):
+        loading = self._loading.get(key)
+        if loading is not None:
+            loading[0] += 1
+
+    def invalidate_where(self, match):
+        """
+        Make keys for which match(key) is true cold
+        """
+        with self._lock:
+            self._epoch += 1
+            for key in [key for key in self._buffers if match(key)]:
+                del self._buffers[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._buffers), 'loading': len(self._loading)}
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+import json
+import secrets
+import string
+import threading
+import time
+
+from cache import LRUCache
+from model import save_callback_payloads, get_callback_payload
+
+
+ALPHABET = string.digits + string.ascii_letters
+
+
+def encode_base62(number:int):
+    """
+    Base-62 representation of non-negative int
+    """
+    digits = []
+    while True:
+        number, digit = divmod(number, len(ALPHABET))
+        digits.append(ALPHABET[digit])
+        if number == 0:
+            return ''.join(reversed(digits))
+
+
+class CallbackRegistry:
+    """
+    Keeps inline keyboard payloads server-side and puts only a short token to callback_data.
+
+    Tokens are random 64 bit numbers in base-62 (at most 11 bytes whatever the payload is),
+    so buttons of unknown menus resolve to nothing instead of someone else's payload.
+    Payloads are kept in an in-process LRU and in the bot_state table, so menus survive
+    restarts and resolve on any instance. Resolving a token registered by this process does not
+    touch the database. Tokens older than `ttl` seconds are expired and resolve to None.
+
+    Payloads are tuples of JSON values, datetimes and namedtuples of the given `types`.
+    """
+
+    def __init__(self, maxsize:int=100000, ttl:float=24 * 3600, types:tuple=(), cleanup_interval:float=3600):
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._payloads = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._types = {cls.__name__: cls for cls in types}
+        # Registered by the thread and not saved yet
+        self._local = threading.local()
+        self._cleaned = time.monotonic()
+
+    def register(self, payload):
+        """
+        Returns token to use as callback_data. Payload is saved to the database by save()
+        """
+        token = encode_base62(secrets.randbits(64))
+        self._payloads.set(token, payload)
+        self._unsaved().append((token, json.dumps(self._encode(payload), separators=(',', ':'), ensure_ascii=False)))
+        return token
+
+    def save(self):
+        """
+        Save payloads registered by this thread in one insert. Called once the keyboard is built.
+        Expired payloads are deleted once per `cleanup_interval`
+        """
+        payloads, self._local.unsaved = self._unsaved(), []
+        expired_before = None
+        if time.monotonic() - self._cleaned > self.cleanup_interval:
+            self._cleaned = time.monotonic()
+            expired_before = self._expired_before()
+        if payloads or expired_before:
+            save_callback_payloads(payloads=payloads, expired_before=expired_before)
+
+    def resolve(self, token:str):
+        """
+        Returns registered payload or None if token is expired or unknown
+        """
+        payload = self._payloads.get(token)
+        if payload is None:
+            # Registered before a restart or by another instance
+            data = get_callback_payload(token=token, created_after=self._expired_before())
+            if data is not None:
+                payload = self._decode(json.loads(data))
+                self._payloads.set(token, payload)
+        return payload
+
+    def stats(self):
+        return self._payloads.stats()
+
+    def _unsaved(self):
+        if not hasattr(self._local, 'unsaved'):
+            self._local.unsaved = []
+        return self._local.unsaved
+
+    def _expired_before(self):
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def _encode(self, value):
+        if isinstance(value, tuple) and hasattr(value, '_fields'):
+            return {'type': type(value).__name__, 'fields': [self._encode(item) for item in value]}
+        if isinstance(value, (tuple, list)):
+            return [self._encode(item) for item in value]
+        if isinstance(value, datetime):
+            return {'datetime': value.isoformat()}
+        return value
+
+    def _decode(self, value):
+        if isinstance(value, list):
+            return tuple(self._decode(item) for item in value)
+        if isinstance(value, dict):
+            if 'datetime' in value:
+                return datetime.fromisoformat(value['datetime'])
+            return self._types[value['type']](*(self._decode(item) for item in value['fields']))
+        return value
@@ -0,0 +1,44 @@
+import csv
+import gzip
+import io
+import json
+
+from model import iter_leaderboard_history
+
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+COLUMNS = ('time_created', 'user_id', 'user', 'activity', 'points')
+
+
+def export_filename(leaderboard_id:int, format:str):
+    return f'leaderboard_{leaderboard_id}.{format}.gz'
+
+def write_export(leaderboard_id:int, fileobj, format:str='csv', batch_size:int=1000):
+    """
+    Write gzip-compressed execution history of the chat to binary fileobj as CSV with a header
+    or as JSON Lines. Rows are streamed from the database to the file. Returns number of rows
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {format}')
+    rows = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        history = iter_leaderboard_history(leaderboard_id=leaderboard_id, batch_size=batch_size)
+        if format == 'csv':
+            writer = csv.writer(text)
+            writer.writerow(COLUMNS)
+            for row in history:
+                writer.writerow(_values(row))
+                rows += 1
+        else:
+            for row in history:
+                text.write(json.dumps(dict(zip(COLUMNS, _values(row))), ensure_ascii=False) + '\n')
+                rows += 1
+        text.flush()
+        # Leave closing to GzipFile, fileobj stays open
+        text.detach()
+    return rows
+
+def _values(row):
+    time_created, user_id, name, activity_name, points = row
+    return (time_created.isoformat(), user_id, name, activity_name, points)
@@ -0,0 +1,173 @@
+from collections import namedtuple, Counter
+from datetime import datetime, timezone
+import csv
+import gzip
+import hashlib
+import time
+
+from model import get_leaderboard_activities, prepare_import, save_imported_executions, finish_import
+
+
+# Error rows kept for the report, the rest are only counted
+MAX_ERROR_ROWS = 100
+
+ImportRow = namedtuple('ImportRow', ['time_created', 'user_id', 'user', 'activity', 'points'])
+ImportReport = namedtuple('ImportReport', ['rows', 'activities', 'executions', 'duplicates', 'errors',
+                                           'error_rows', 'seconds'])
+
+
+class ImportFormatError(Exception):
+    """
+    File is not a CSV with an activity column
+    """
+
+
+def import_history(path:str, leaderboard_id:int, leaderboard_name:str=None, author_user_id:int=None,
+                   author_name:str=None, chunk_size:int=1000):
+    """
+    Import Activities and executions of a chat from a CSV file (gzip-compressed or plain).
+
+    Columns are the ones written by export.py: time_created, user_id, user, activity, points.
+    Rows with only activity and points declare Activities. The file is read twice:
+    a validation pass that collects Activities, users and error rows, and a load pass that inserts
+    executions in chunked transactions. Executions get a tap_id derived from their content and
+    the number of the same execution earlier in the file. Executions the chat already has are skipped,
+    so importing the same file or an export of the chat again adds nothing.
+    Returns ImportReport
+    """
+    started = time.monotonic()
+    validator = _Validator({row.activity_name: row.points for row in get_leaderboard_activities(leaderboard_id)})
+    users = {}
+    rows, executions, errors, error_rows = 0, 0, 0, []
+    for line, values in _read(path):
+        rows += 1
+        row, error = validator.check(values)
+        if error:
+            errors += 1
+            if len(error_rows) < MAX_ERROR_ROWS:
+                error_rows.append((line, error))
+        elif row.user_id is not None:
+            executions += 1
+            if row.user or row.user_id not in users:
+                users[row.user_id] = row.user or str(row.user_id)
+
+    activity_ids, participant_ids = prepare_import(
+        leaderboard_id=leaderboard_id, leaderboard_name=leaderboard_name or str(leaderboard_id),
+        activities=validator.activities, users=users, author_user_id=author_user_id,
+        author_name=author_name, chunk_size=chunk_size)
+
+    inserted, chunk = 0, []
+    # Same user, Activity and time can repeat anywhere in the file, e.g. exports have second precision
+    occurrences = Counter()
+    for line, values in _read(path):
+        row, error = validator.check(values)
+        if error or row.user_id is None:
+            continue
+        key = (leaderboard_id, row.user_id, row.activity, row.time_created.isoformat())
+        occurrence = occurrences[key]
+        occurrences[key] += 1
+        chunk.append({'tap_id': _tap_id(key, occurrence), 'activity_id': activity_ids[row.activity],
+                      'participant_id': participant_ids[row.user_id], 'leaderboard_id': leaderboard_id,
+                      'time_created': row.time_created, 'occurrence': occurrence})
+        if len(chunk) >= chunk_size:
+            inserted += save_imported_executions(executions=chunk)
+            chunk = []
+    if chunk:
+        inserted += save_imported_executions(executions=chunk)
+    finish_import(leaderboard_id=leaderboard_id)
+
+    return ImportReport(rows=rows, activities=validator.created, executions=inserted,
+                        duplicates=executions - inserted, errors=errors, error_rows=error_rows,
+                        seconds=time.monotonic() - started)
+
+
+class _Validator:
+    """
+    Parses CSV rows. Points of an Activity come from the chat or from its first valid row in the file,
+    rows with other points are errors
+    """
+
+    def __init__(self, activities:dict):
+        self.activities = dict(activities)
+        self.created = 0
+
+    def check(self, values:dict):
+        """
+        Returns (ImportRow, None) or (None, error message)
+        """
+        activity = (values.get('activity') or '').strip()
+        if not activity:
+            return None, 'activity is empty'
+        if len(activity) > 255:
+            return None, 'activity is longer than 255 characters'
+
+        points = (values.get('points') or '').strip()
+        if points:
+            try:
+                points = int(points)
+            except ValueError:
+                return None, f'points {points} is not a number'
+        else:
+            points = None
+
+        user_id = (values.get('user_id') or '').strip()
+        time_created = (values.get('time_created') or '').strip()
+        if user_id or time_created:
+            try:
+                user_id = int(user_id)
+            except ValueError:
+                return None, f'user_id {user_id} is not a number'
+            try:
+                time_created = _parse_time(time_created)
+            except ValueError:
+                return None, f'time_created {time_created} is not an ISO date and time'
+        else:
+            user_id, time_created = None, None
+        user = (values.get('user') or '').strip()[:255]
+
+        known = self.activities.get(activity)
+        if known is None:
+            if points is None:
+                return None, f'points of new Activity {activity} are missing'
+            self.activities[activity] = points
+            self.created += 1
+        elif points is not None and points != known:
+            return None, f'points {points} differ from {known} points of {activity}'
+        return ImportRow(time_created, user_id, user, activity, points), None
+
+
+def _parse_time(value:str):
+    """
+    ISO date and time, UTC if no offset is given. Returns naive UTC datetime like time_created columns
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def _tap_id(key:tuple, occurrence:int):
+    return 'i' + hashlib.sha1(repr((key, occurrence)).encode('utf-8')).hexdigest()[:31]
+
+def _read(path:str):
+    """
+    Yields (line number, row dict with lower case column names)
+    """
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == b'\x1f\x8b'
+    opener = gzip.open if compressed else open
+    # utf-8-sig drops the BOM spreadsheet applications put in front of CSV files
+    with opener(path, 'rt', encoding='utf-8-sig', newline='') as file:
+        reader = csv.DictReader(file)
+        try:
+            fieldnames = reader.fieldnames
+        except (csv.Error, UnicodeDecodeError, OSError) as e:
+            raise ImportFormatError(f'Not a CSV file: {e}')
+        fieldnames = [name.strip().lower() for name in fieldnames or ()]
+        if 'activity' not in fieldnames:
+            raise ImportFormatError('CSV header with an activity column is required')
+        reader.fieldnames = fieldnames
+        try:
+            for values in reader:
+                yield reader.line_num, values
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise ImportFormatError(f'Line {reader.line_num}: {e}')
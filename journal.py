@@ -0,0 +1,209 @@
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import uuid
+
+from sqlalchemy import exc
+
+from model import save_taps, leaderboard_versions
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindJournal:
+    """
+    Write-behind buffer for activity executions.
+
+    record() appends the tap to a local append-only journal (fsync'ed) and returns
+    right away. Taps are saved to the database by save_taps() in one transaction
+    every `flush_interval` seconds or as soon as `batch_size` taps are waiting,
+    then removed from the journal. Taps left in the journal by a crash are saved on the
+    next start. Every tap has a unique tap_id stored with the row, so a tap saved right
+    before the crash is not saved twice. A batch that fails is retried tap by tap, taps the
+    database rejects are moved to `path`.dead instead of blocking the ones behind them.
+
+    Points of waiting taps are kept per (leaderboard, user) and added to the score by
+    overlay_score(), so users see their taps before they are in the database.
+    One journal file per process.
+    """
+
+    def __init__(self, path:str, flush_interval:float=0.2, batch_size:int=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._entries = []
+        # (leaderboard_id, user_id) -> [points, number] of waiting taps
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._running = False
+        self._thread = None
+        self.dead_letter_path = path + '.dead'
+        self.stats = {'recorded': 0, 'flushes': 0, 'saved': 0, 'skipped': 0, 'errors': 0, 'dead': 0}
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line cut by a crash during append, the tap was never acknowledged
+                        continue
+                    self._entries.append(entry)
+                    self._add_pending(entry)
+            if self._entries:
+                logger.info(f'Replaying {len(self._entries)} tap(s) from {path}')
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop flushing thread and save waiting taps
+        """
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        self._file.close()
+        logger.info(f'Write-behind journal stopped. {self.stats}')
+
+    def record(self, user_id:int, leaderboard_id:int, activity_id:int, points:int, user_name:str=None):
+        """
+        Durably buffer execution of the Activity
+        """
+        entry = {'tap_id': uuid.uuid4().hex, 'user_id': user_id, 'user_name': user_name, 'leaderboard_id': leaderboard_id,
+                 'activity_id': activity_id, 'points': points, 'time_created': datetime.utcnow().isoformat()}
+        with self._lock:
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries.append(entry)
+            self._add_pending(entry)
+            self.stats['recorded'] += 1
+            if len(self._entries) >= self.batch_size:
+                self._wakeup.notify()
+        # Rendered score includes waiting taps
+        leaderboard_versions.bump(leaderboard_id)
+
+    def overlay_score(self, leaderboard_id:int, score):
+        """
+        Adds points of waiting taps to score rows (user_id, name, points).
+        Returns list of dicts ordered by points
+        """
+        with self._lock:
+            pending = {user_id: points for (board_id, user_id), (points, _) in self._pending.items()
+                       if board_id == leaderboard_id}
+        rows = [{'name': row['name'], 'points': row['points'] + pending.get(row['user_id'], 0)} for row in score]
+        if pending:
+            rows.sort(key=lambda row: row['points'], reverse=True)
+        return rows
+
+    def flush(self):
+        """
+        Save waiting taps. Called by the flushing thread and before reads that need the rows.
+        Taps are saved in their own transaction and removed from the journal after it is committed
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries[:self.batch_size]
+            while entries:
+                try:
+                    saved = save_taps(taps=[self._tap(entry) for entry in entries])
+                except Exception as e:
+                    if _transient(e):
+                        raise
+                    logger.warning(f'Saving {len(entries)} tap(s) failed, saving them one by one: {e}')
+                    saved = self._save_one_by_one(entries)
+                self._forget(entries)
+                self.stats['flushes'] += 1
+                self.stats['saved'] += saved
+                self.stats['skipped'] += len(entries) - saved
+                with self._lock:
+                    entries = self._entries[:self.batch_size]
+
+    def _save_one_by_one(self, entries:list):
+        """
+        Save taps of a failed batch separately. Taps rejected by the database go to the dead-letter file.
+        Returns number of saved taps
+        """
+        saved, dead = 0, []
+        for entry in entries:
+            try:
+                saved += save_taps(taps=[self._tap(entry)])
+            except Exception as e:
+                if _transient(e):
+                    raise
+                logger.error(f'Moving tap {entry["tap_id"]} to {self.dead_letter_path}: {e}')
+                dead.append(entry)
+        if dead:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+                for entry in dead:
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.stats['dead'] += len(dead)
+        return saved
+
+    @staticmethod
+    def _tap(entry:dict):
+        return dict(entry, time_created=datetime.fromisoformat(entry['time_created']))
+
+    def _forget(self, entries:list):
+        """
+        Remove saved entries from memory, then from the journal
+        """
+        with self._lock:
+            del self._entries[:len(entries)]
+            for entry in entries:
+                self._add_pending(entry, sign=-1)
+            # Rewrite the journal with taps recorded during the flush
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self._entries:
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        # Saved rows replace pending points in the rendered score
+        for leaderboard_id in {entry['leaderboard_id'] for entry in entries}:
+            leaderboard_versions.bump(leaderboard_id)
+
+    def _add_pending(self, entry:dict, sign:int=1):
+        key = (entry['leaderboard_id'], entry['user_id'])
+        points, number = self._pending.get(key, (0, 0))
+        if number + sign:
+            self._pending[key] = (points + sign * entry['points'], number + sign)
+        else:
+            del self._pending[key]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    return
+                if len(self._entries) < self.batch_size:
+                    self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('Failed to flush write-behind journal')
+
+
+def _transient(error:Exception):
+    """
+    Errors of the connection or the database rather than of the taps. Taps stay in the journal
+    """
+    return isinstance(error, (exc.OperationalError, exc.InterfaceError, exc.TimeoutError))
@@ -1,16 +1,37 @@
+import functools
 import logging
+import math
 
 import telegram
 from telegram import (Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply)
-from telegram.ext import (Updater, MessageHandler, CommandHandler, ConversationHandler, Filters, CallbackQueryHandler)
+from telegram.ext import (Updater, MessageHandler, CommandHandler, ConversationHandler, Filters, CallbackQueryHandler, JobQueue)
+from queue import Queue
 
 import os 
+import pytz
+import tempfile
+from collections import namedtuple
 
-from model import (Activity, init_db, get_activities_by_user_id, get_activity_by_id, delete_activity_by_id, get_leaderboard_activities,
+from model import (Activity, init_db, dispose_engine, unit_of_work, get_activities_by_user_id, get_activity_by_id, delete_activity_by_id, get_leaderboard_activities,
                     Leaderboard, get_leaderboard_by_id, leaderboard_has_activities, get_leaderboard_by_activity_id,
                     User, get_user_by_id, get_leaderboard_score, get_performed_activities, get_performed_activity_by_id,
-                    Participant, get_participant_by_user_id_and_leaderboard_id,get_leaderboard_log, 
-                    Performed_Activity)
+                    Participant, get_participant_by_user_id_and_leaderboard_id,get_leaderboard_log, onboard, update_activity_points,
+                    Performed_Activity, get_leaderboard_version, get_activities_page, ACTIVITY_PAGE_SIZE,
+                    get_recent_activities, delete_performed_activity_by_id, ActivityRow, RecentActivity,
+                    score_window_start, get_leaderboard_timezone, set_leaderboard_timezone, get_rank_index,
+                    refresh_global_scores, get_global_top, get_global_leaderboard_rank, activity_cache)
+from model import pool_size as db_pool_size, max_overflow as db_max_overflow, get_pool_stats
+from cache import LRUCache
+from queries import get_query_stats
+from runtime import AsyncioRuntime, ShardedDispatcher, UnitOfWorkRequest
+from persistence import SQLPersistence
+from outbox import Outbox, QueuedBot
+from callbacks import CallbackRegistry
+from journal import WriteBehindJournal
+from analytics import get_activity_stats, get_user_names
+from scheduler import PeriodicJob
+from export import EXPORT_FORMATS, export_filename, write_export
+from importer import import_history, ImportFormatError
 import gcloud
 
 
@@ -20,12 +41,45 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
+# Compact UI: clicked inline menu is edited into the result or the next menu
+# instead of removing its keyboard and sending new messages
+COMPACT_UI = os.environ.get('COMPACT_UI') == '1'
+
+# /show_score periods
+SCORE_WINDOWS = ('week', 'month', 'all')
+# Participants listed by /show_score
+SCORE_TOP_N = int(os.environ.get('SCORE_TOP_N', 20))
+# Chats and users listed by /global_top
+GLOBAL_TOP_N = int(os.environ.get('GLOBAL_TOP_N', 10))
+# Seconds between stats log lines, 0 disables them
+STATS_INTERVAL = float(os.environ.get('STATS_INTERVAL', 60))
+# Telegram bots can upload documents up to 50 MB and download up to 20 MB
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+# Write-behind journal of activity executions, set up in main() when WRITE_BEHIND=1
+write_behind = None
+
+# Rendered /show_score and /show_log texts keyed by (chat_id, view, leaderboard version)
+rendered_cache = LRUCache(maxsize=int(os.environ.get('RENDER_CACHE_SIZE', 1024)),
+                          ttl=int(os.environ.get('RENDER_CACHE_TTL', 600)))
+
 # State variables
 ACTIVITY, POINTS, IDLE, DELETE, EXECUTE_ACTIVITY, CANCEL,UPDATE,UPDATE_FINILAZE, CHANGE_ACTIVITY_NAME, CHANGE_ACTIVITY_POINTS   = range(10) 
 
 # Variables for start flow 
 EXECUTE, TO_ADD, TO_DELETE, SCORE, LOG, CANCEL, CHANGE_POINTS, CHANGE_NAME = range(8)
 
+# Position in the activity list. Payload of prev/next buttons,
+# offset is the number of activities on previous pages
+ActivityPageRef = namedtuple('ActivityPageRef', ['after_id', 'before_id', 'offset'])
+FIRST_PAGE = ActivityPageRef(None, None, 0)
+
+# Payloads of activity menu buttons, callback_data holds only a token
+callback_registry = CallbackRegistry(maxsize=int(os.environ.get('CALLBACK_REGISTRY_SIZE', 100000)),
+                                     ttl=int(os.environ.get('CALLBACK_TTL', 24 * 3600)),
+                                     types=(ActivityRow, RecentActivity, ActivityPageRef))
+
 
 #TODO: 
 # - Fix format of log on mobile
@@ -39,32 +93,45 @@ EXECUTE, TO_ADD, TO_DELETE, SCORE, LOG, CANCEL, CHANGE_POINTS, CHANGE_NAME = ran
 # start - Enter chat's Leaderboard
 # execute_activity - Record Activity Execution
 # cancel_activity - Cancel Executed Activity
-# show_score - Show current score 
+# show_score - Show current score. /show_score week|month|all 
 # add_activity - Add new Activity
 # delete_activity - Delete Activity
 # update_activity - Change name or points of the Activity
 # show_activities - Show Leaderboard's Activityes 
 # show_log - Show last 10 Executed Activities
 # cancel - End interaction with the bot
+# set_timezone - Set chat timezone for week and month scores
+# activity_stats - Show who did Activities last and how often
+# my_rank - Show your place in the Leaderboard
+# global_top - Show top chats and users across all Leaderboards
+# export - Download history of Executed Activities. /export csv|jsonl
+# Import: send a CSV file (columns time_created, user_id, user, activity, points) with /import as the caption
 
 #TODO: After show activities allow to click on each activity and show additional actions:
 #[who last executed/log; how often on average activity is executed (monthly, weekly) overall and per user; edit -> name; points; delete  ]
 
+@unit_of_work
 def start(update: Update, context):
 
     update.message.reply_text(
         'Ok, let\'s start'
     )
 
-    # Create Leaderboard if do not exists 
-    leaderboard = create_leaderboard(update, context)
-    # Create/Update User 
-    user = create_user(update, context)
-    # Add user to the Leaderboard
-    add_participant(update, user, leaderboard)
+    chat_id = update.effective_chat.id
+    leaderboard_name = get_leaderboard_name(update)
+    user_id = update.effective_user.id
+    user_name = update.effective_user.username
+
+    # Create/Update Leaderboard and User, add User to the Leaderboard
+    participant_added, acitivity_exists = onboard(leaderboard_id=chat_id, leaderboard_name=leaderboard_name,
+                                                  user_id=user_id, user_name=user_name)
 
-    # Get leaderboard activities 
-    acitivity_exists = leaderboard_has_activities(leaderboard_id = leaderboard.id)
+    #If group chat - notify participants that new participant was added 
+    if participant_added and update.effective_chat.type != 'private':
+        update.message.reply_text(
+            f'{user_name} was added to the Leaderboard {leaderboard_name}', 
+            quote=False
+        )
 
     if not acitivity_exists:
         # Telegram clients will display a reply interface to the user 
@@ -80,70 +147,105 @@ def start(update: Update, context):
         return wait_for_input(update, context)
 
 
-def create_leaderboard(update:Update, context):
+def get_leaderboard_name(update:Update):
     """
-    Create Leaderboard if do not exists 
-    Update Leaderboard if exists
+    Leaderboard name is equal to the name of the Chat conversation
     """
-    chat_id = update.effective_chat.id
-    chat_type = update.effective_chat.type
-
-    if chat_type == 'private':
-        leaderboard_name = update.effective_chat.username
-    else: 
-        leaderboard_name = update.effective_chat.title
-
-    leaderboard = get_leaderboard_by_id(leaderboard_id=chat_id)
-    
+    if update.effective_chat.type == 'private':
+        return update.effective_chat.username
+    return update.effective_chat.title
 
-    #If leaderboard is not present - create new
-    if not leaderboard:
-        leaderboard = Leaderboard(id=chat_id, name=leaderboard_name)
-    else:
-        #Update Leaderboard name, in case Chat name was updated
-        leaderboard.name = leaderboard_name
-    leaderboard.save_leaderboard()
 
-    return leaderboard
+def close_menu(update:Update, choice_text:str=None):
+    """
+    Remove inline keyboard of the clicked menu and send the choice as a message.
+    In compact UI the menu is edited later by reply
+    """
+    if COMPACT_UI:
+        return
+    query = update.callback_query
+    query.edit_message_reply_markup(None)
+    if choice_text:
+        query.message.reply_text(choice_text, quote=False)
 
-def create_user(update:Update, context):
+def reply(update:Update, text:str, reply_markup=None, **kwargs):
     """
-    Check if User is db, create if not, update is yes
+    Send message to the chat. In compact UI the first reply to a click edits the clicked menu.
+    ForceReply can't be attached to an edited message, so then only the keyboard is removed
     """
-    user_id = update.effective_user.id
-    user_name = update.effective_user.username
-    user = get_user_by_id(id=user_id)
+    query = update.callback_query
+    if COMPACT_UI and query and not getattr(update, '_menu_edited', False):
+        update._menu_edited = True
+        if not isinstance(reply_markup, ForceReply):
+            query.edit_message_text(text, reply_markup=reply_markup)
+            return
+        query.edit_message_reply_markup(None)
+    update.effective_message.reply_text(text, reply_markup=reply_markup, **kwargs)
+
+def choice_button(text:str, button_id:int, item=None):
+    """
+    Inline button of a menu. Position of the button and the chosen item snapshot
+    are kept in callback_registry, item is None for Cancel
+    """
+    return InlineKeyboardButton(text, callback_data=callback_registry.register((button_id, item)))
 
-    if not user:
-        user = User(name=user_name, id=user_id)
-    else:
-        #Adding this check because user can change the name
-        user.name = user_name
-    user.save_user()
-    return user
+def choice_markup(keyboard:list):
+    """
+    Keyboard of choice buttons. Saves their payloads, so the menu works after a restart and on other instances
+    """
+    callback_registry.save()
+    return InlineKeyboardMarkup(keyboard)
 
-def add_participant(update:Update, user:User, leaderboard:Leaderboard):
+def activity_menu(leaderboard_id:int, page_ref:ActivityPageRef=FIRST_PAGE):
     """
-    Add Participant to db if not present
+    One page of activities as inline keyboard with prev/next navigation and Cancel.
+    Returns (ActivityPage, InlineKeyboardMarkup)
     """
-    chat_type = update.effective_chat.type
-    participant = get_participant_by_user_id_and_leaderboard_id(user_id = user.id, leaderboard_id=leaderboard.id)
+    page = get_activities_page(leaderboard_id, after_id=page_ref.after_id, before_id=page_ref.before_id)
+    keyboard = []
+    for indx, act in enumerate(page.activities):
+        keyboard.append([choice_button(f'{act.activity_name} - {act.points} points', indx, act)])
 
-    if not participant: 
-        participant = Participant(user_id = user.id, leaderboard_id=leaderboard.id)
-        participant.save_participant()
+    navigation = page_navigation(page, page_ref,
+                                 lambda text, ref: choice_button(text, len(keyboard), ref))
+    if navigation:
+        keyboard.append(navigation)
 
-        #If group chat - notify participants that new participant was added 
-        if chat_type != 'private':
-            update.message.reply_text(
-                f'{user.name} was added to the Leaderboard {leaderboard.name}', 
-                quote=False
-            )
-    return participant   
+    keyboard.append([choice_button(f'❌ Cancel', len(keyboard))])
+    return page, choice_markup(keyboard)
+
+def page_navigation(page, page_ref:ActivityPageRef, button):
+    """
+    Prev/next buttons built by button(text, ActivityPageRef)
+    """
+    navigation = []
+    if page.has_prev:
+        # Page after a deleted tail may be empty
+        first_id = page.activities[0].id if page.activities else page_ref.after_id + 1
+        navigation.append(button('⬅️ Prev', ActivityPageRef(None, first_id, max(page_ref.offset - ACTIVITY_PAGE_SIZE, 0))))
+    if page.has_next and page.activities:
+        navigation.append(button('Next ➡️', ActivityPageRef(page.activities[-1].id, None, page_ref.offset + len(page.activities))))
+    return navigation
+
+def turn_page(update:Update, page_ref:ActivityPageRef, state:int):
+    """
+    Replace keyboard of the clicked activity menu with another page. Conversation stays in `state`
+    """
+    _, keyboard_markup = activity_menu(update.effective_chat.id, page_ref)
+    update.callback_query.edit_message_reply_markup(keyboard_markup)
+    return state
 
+def menu_expired(update:Update, context):
+    """
+    Clicked menu is older than callback_registry keeps payloads. Show main menu again
+    """
+    close_menu(update)
+    reply(update, 'This menu has expired 🤷🏻', quote = False)
+    return wait_for_input(update, context)
 
 
 #/add_activity command handler
+@unit_of_work
 def add_activity_command_handler(update:Update, context):
     #If command was triggered from inline keyboard submit
     query = update
@@ -152,7 +254,7 @@ def add_activity_command_handler(update:Update, context):
         query.answer()
 
     force_reply = ForceReply(force_reply=True)
-    query.message.reply_text(
+    reply(update,
         f'What is the name of the Activity?', 
         reply_markup=force_reply,
         quote = False
@@ -160,6 +262,7 @@ def add_activity_command_handler(update:Update, context):
     return ACTIVITY
 
 #TODO: Add check if activity with same name.lower() exists
+@unit_of_work
 def add_activity(update: Update, context):
     activity = update.message.text
     if not activity:
@@ -185,6 +288,7 @@ def add_activity(update: Update, context):
     return POINTS
 
 
+@unit_of_work
 def add_points(update: Update, context):
     points = update.message.text
     try:
@@ -239,7 +343,7 @@ def wait_for_input(update:Update, context):
     else:
         query = update.callback_query
         query.answer()
-        query.message.reply_text(
+        reply(update,
             message_text, reply_markup = keyboard_markup,
             quote = False
         )
@@ -248,6 +352,7 @@ def wait_for_input(update:Update, context):
     return IDLE
 
 
+@unit_of_work
 def idle(update:Update, context):
     
     query = update.callback_query
@@ -257,49 +362,30 @@ def idle(update:Update, context):
     choice = int(query.data)
 
 
-    #Remove InLineKeyboard
-    query.edit_message_text(
-        query.message.text
-    )
+    keyboard = query.message.reply_markup.inline_keyboard
 
+    #Remove InLineKeyboard, send user choice as a message
     if choice == EXECUTE:
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[0][0].text, 
-            quote=False
-        )
+        close_menu(update, keyboard[0][0].text)
         return execute_activity_command_handler(update, context)
     elif choice == TO_ADD:
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[1][0].text,
-            quote = False
-        )
+        close_menu(update, keyboard[1][0].text)
         return add_activity_command_handler(update, context)
     elif choice == TO_DELETE: 
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[1][1].text,
-            quote = False
-        )
+        close_menu(update, keyboard[1][1].text)
         return delete_command_handler(update, context)
     elif choice == SCORE:
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[2][0].text,
-            quote = False
-        )
+        close_menu(update, keyboard[2][0].text)
         return show_score_command_handler(update, context)
     elif choice == LOG:
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[2][1].text,
-            quote = False
-        )
+        close_menu(update, keyboard[2][1].text)
         return show_log_command_handler(update, context)
     elif choice == CANCEL:
-        query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[3][0].text,
-            quote = False
-        )
+        close_menu(update, keyboard[3][0].text)
         return cancel(update, context)
 
 # /execute_activity command handler
+@unit_of_work
 def execute_activity_command_handler(update:Update, context):
     #If command was triggered from inline keyboard submit
     query = update
@@ -308,83 +394,72 @@ def execute_activity_command_handler(update:Update, context):
         query.answer()
 
     
-    # Get leaderboard activities 
+    # Get first page of leaderboard activities 
     leaderboard_id = update.effective_chat.id
-    activities = get_leaderboard_activities(leaderboard_id = leaderboard_id)
+    page, keyboard_markup = activity_menu(leaderboard_id)
 
-    if activities.count() < 1:
+    if not page.activities:
         # Telegram clients will display a reply interface to the user 
         # (act as if the user has selected the bot’s message and tapped ‘Reply’) 
         force_reply = ForceReply(force_reply=True, selective=True)
-        query.message.reply_text(
+        reply(update,
             'Seems there is no Activities. \nSend me the name of a first activity',
             reply_markup=force_reply,
             quote = False
         )
         return ACTIVITY
     else: 
-        keyboard = []
-        for i, act in enumerate(activities):
-            # Need this to understand what button was clicked
-            data_ = f'{i}_{act.id}_{act.activity_name}_{act.points}'
-            key = [InlineKeyboardButton(f'{act.activity_name} - {act.points} points', callback_data=data_)]
-            keyboard.append(key)
-        
-        key = [InlineKeyboardButton(f'❌ Cancel', callback_data=f"{activities.count()}_{-1}")]
-        keyboard.append(key)
-
-        keyboard_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.message.reply_text(
+        reply(update,
             f'What Acitivity you would like to record?', reply_markup=keyboard_markup,
             quote = False
         )
         return EXECUTE_ACTIVITY
 
+@unit_of_work
 def execute_activity(update:Update, context):
     query = update.callback_query
     query.answer()
 
-    button_id, activity_id, activity_name, points = query.data.split('_')
-    activity_id = int(activity_id)
-    button_id = int(button_id)
+    choice = callback_registry.resolve(query.data)
+    if choice is None:
+        return menu_expired(update, context)
+    button_id, activity = choice
+    if isinstance(activity, ActivityPageRef):
+        return turn_page(update, activity, EXECUTE_ACTIVITY)
 
-    #Remove Inline Keyboard
-    query.edit_message_reply_markup(
-        None, 
-        quote = False
-    )
-    #Send user choise as a message
-    query.message.reply_text(
-        query.message.reply_markup.inline_keyboard[button_id][0].text, 
-        quote=False
-    ) 
+    #Remove Inline Keyboard, send user choise as a message
+    close_menu(update, query.message.reply_markup.inline_keyboard[button_id][0].text)
 
     #Return to user input in case Calcel is clicked
-    if activity_id == -1:
+    if activity is None:
         return wait_for_input(update, context)
     
     user_id = update.effective_user.id
     leaderboard_id = update.effective_chat.id
-    participant = get_participant_by_user_id_and_leaderboard_id(user_id = user_id,
-                                                                 leaderboard_id = leaderboard_id)
-    if not participant: 
+    if write_behind:
+        # Saved to the database with the next batch
+        write_behind.record(user_id = user_id, leaderboard_id = leaderboard_id,
+                            activity_id = activity.id, points = activity.points,
+                            user_name = update.effective_user.username)
+    else:
+        # Upsert returns id of the existing or new participant
         participant = Participant(user_id = user_id, leaderboard_id = leaderboard_id)
         participant.save_participant()
 
+        # Create performed Activity
+        performed_activity = Performed_Activity(activity_id = activity.id, participant_id = participant.id,
+                                                leaderboard_id = leaderboard_id)
+        performed_activity.save_performed_activity(user_id = user_id, activity_name = activity.activity_name)
 
-    # Create performed Activity
-    performed_activity = Performed_Activity(activity_id = activity_id, participant_id = participant.id)    
-    performed_activity.save_performed_activity()
-
-    query.message.reply_text(
-            f'Activity {activity_name} was tracked\n'
-            f'{points} points were added to @{update.effective_user.username}', 
+    reply(update,
+            f'Activity {activity.activity_name} was tracked\n'
+            f'{activity.points} points were added to @{update.effective_user.username}', 
             quote=False
         )
     return ConversationHandler.END
 
 # Handles /delete_activity command
+@unit_of_work
 def delete_command_handler(update:Update, context):
     
     #If command was triggered from inline keyboard submit
@@ -393,30 +468,18 @@ def delete_command_handler(update:Update, context):
         query = update.callback_query
         query.answer()
 
-    # Get leaderboard activities 
-    activities = get_leaderboard_activities(leaderboard_id = update.effective_chat.id)
+    # Get first page of leaderboard activities 
+    page, keyboard_markup = activity_menu(update.effective_chat.id)
 
     # If there is no activities return to default
-    if activities.count() < 1:
-        query.message.reply_text(
+    if not page.activities:
+        reply(update,
             f'✋ There are no activities 😐',
             quote = False
         )
         return wait_for_input(update, context)
     else:
-        keyboard = []
-        #TODO: Add Cancel button. Should abort deletion of the activity. 
-        # Should end interaction with bot 
-        for indx, act in enumerate(activities):
-            key = [InlineKeyboardButton(f'{act.activity_name} - {act.points} points', callback_data=f"{indx}_{act.id}")]
-            keyboard.append(key)
-        
-        key = [InlineKeyboardButton(f'❌ Cancel', callback_data=f"{activities.count()}_{-1}")]
-        keyboard.append(key)
-
-        keyboard_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.message.reply_text(
+        reply(update,
             f'What Acitivity you would like to delete?', reply_markup=keyboard_markup,
             quote = False
         )
@@ -427,33 +490,29 @@ def delete_command_handler(update:Update, context):
 
 
 #TODO: Check if any Performed_Activity entities exists. If Yes ask for confirmation 
+@unit_of_work
 def delete(update:Update, context):
     query = update.callback_query
     query.answer()
 
-    button_id, activity_id = query.data.split('_')
-    activity_id = int(activity_id)
-    button_id = int(button_id)
-
-    #Remove Inline Keyboard
-    query.edit_message_reply_markup(
-        None
-    )
+    choice = callback_registry.resolve(query.data)
+    if choice is None:
+        return menu_expired(update, context)
+    button_id, activity = choice
+    if isinstance(activity, ActivityPageRef):
+        return turn_page(update, activity, DELETE)
 
-    query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[button_id][0].text, 
-            quote = False
-        )
+    #Remove Inline Keyboard, send user choice as a message
+    close_menu(update, query.message.reply_markup.inline_keyboard[button_id][0].text)
 
-    if activity_id == -1:
+    if activity is None:
         return wait_for_input(update, context)
 
     #Delete activity from the database
-    activity = get_activity_by_id(activity_id=activity_id)
-    activity.delete_activity()
+    delete_activity_by_id(activity_id=activity.id)
 
 
-    query.message.reply_text(
+    reply(update,
             f'Activity {activity.activity_name} was deleted ❌',
             quote = False
         )
@@ -463,6 +522,7 @@ def delete(update:Update, context):
 
 
 # Handles /update_activity command
+@unit_of_work
 def update_activity_command_handler(update:Update, context):
     #If command was triggered from inline keyboard submit
     query = update
@@ -470,54 +530,45 @@ def update_activity_command_handler(update:Update, context):
         query = update.callback_query
         query.answer()
 
-    # Get leaderboard activities 
-    activities = get_leaderboard_activities(leaderboard_id = update.effective_chat.id)
+    # Get first page of leaderboard activities 
+    page, keyboard_markup = activity_menu(update.effective_chat.id)
 
     # If there is no activities return to default
-    if activities.count() < 1:
-        query.message.reply_text(
+    if not page.activities:
+        reply(update,
             f'✋ There are no activities 😐',
             quote = False
         )
         return wait_for_input(update, context)
     else:
-        keyboard = []
-        for indx, act in enumerate(activities):
-            key = [InlineKeyboardButton(f'{act.activity_name} - {act.points} points', callback_data=f"{indx}_{act.id}")]
-            keyboard.append(key)
-        
-        key = [InlineKeyboardButton(f'❌ Cancel', callback_data=f"{activities.count()}_{-1}")]
-        keyboard.append(key)
-
-        keyboard_markup = InlineKeyboardMarkup(keyboard)
-        
-        query.message.reply_text(
+        reply(update,
             f'What Acitivity you would like to update?', reply_markup=keyboard_markup,
             quote = False
         )
 
         return UPDATE
 
+@unit_of_work
 def what_to_update(update:Update, context):
     query = update.callback_query
     query.answer()
 
-    button_id, activity_id = query.data.split('_')
-    activity_id = int(activity_id)
-    button_id = int(button_id)
+    choice = callback_registry.resolve(query.data)
+    if choice is None:
+        return menu_expired(update, context)
+    button_id, activity = choice
+    if isinstance(activity, ActivityPageRef):
+        return turn_page(update, activity, UPDATE)
 
     #Remove Inline Keyboard
-    query.edit_message_reply_markup(
-        None
-    )
+    close_menu(update)
 
-    if activity_id == -1:
+    if activity is None:
+        if COMPACT_UI:
+            query.edit_message_reply_markup(None)
         return ConversationHandler.END
 
-    activity = get_activity_by_id(activity_id=activity_id)
-
-
-    
+    activity_id = activity.id
     keyboard = []
     keys = [InlineKeyboardButton(f'📋 Change name', callback_data=f"{activity_id}_{CHANGE_NAME}"), InlineKeyboardButton(f'💎 Change points', callback_data=f"{activity_id}_{CHANGE_POINTS}")]
     back_key = [InlineKeyboardButton(f'🔙 Back', callback_data=f"{activity_id}_{-1}")]
@@ -525,7 +576,7 @@ def what_to_update(update:Update, context):
     keyboard.append(back_key)
     keyboard_markup = InlineKeyboardMarkup(keyboard)
 
-    query.message.reply_text(
+    reply(update,
         f"{activity.activity_name} — {activity.points}💎", reply_markup=keyboard_markup,
         quote = False
     )
@@ -533,6 +584,7 @@ def what_to_update(update:Update, context):
     # Get new user input
     return UPDATE_FINILAZE
 
+@unit_of_work
 def update_activity(update:Update, context):
     if  update.callback_query is None:
         activity_id = context.user_data[ACTIVITY]
@@ -543,10 +595,7 @@ def update_activity(update:Update, context):
         activity_id, button_id = query.data.split('_')
         query.answer()
         #Remove Inline Keyboard
-        query.edit_message_reply_markup(
-            None, 
-            quote = False
-        )
+        close_menu(update)
 
     activity_id = int(activity_id)
     button_id = int(button_id)
@@ -559,14 +608,14 @@ def update_activity(update:Update, context):
         return update_activity_command_handler(update, context)
     elif button_id == CHANGE_NAME:
         
-        if update.callback_query is not None:
+        if update.callback_query is not None and not COMPACT_UI:
             query.message.reply_text(
                 query.message.reply_markup.inline_keyboard[0][0].text, 
                 quote=False
             )
 
         force_reply = ForceReply(force_reply=True)         
-        query.message.reply_text(
+        reply(update,
             f'What is the new name of the activity',
             reply_markup=force_reply, 
             quote=False
@@ -575,13 +624,13 @@ def update_activity(update:Update, context):
 
     elif button_id == CHANGE_POINTS:
         activity = get_activity_by_id(activity_id=activity_id)
-        if update.callback_query is not None:
+        if update.callback_query is not None and not COMPACT_UI:
             query.message.reply_text(
                 query.message.reply_markup.inline_keyboard[0][0].text, 
                 quote=False
             )
         force_reply = ForceReply(force_reply=True)       
-        query.message.reply_text(
+        reply(update,
             f'How many points should I assign for {activity.activity_name} ?', 
             reply_markup=force_reply, 
             quote=False
@@ -589,6 +638,7 @@ def update_activity(update:Update, context):
         return CHANGE_ACTIVITY_POINTS
 
     
+@unit_of_work
 def change_activity_name(update:Update, context):
     activity_name = update.message.text
     activity_id = context.user_data[ACTIVITY]
@@ -613,6 +663,7 @@ def change_activity_name(update:Update, context):
     )
     return ConversationHandler.END 
 
+@unit_of_work
 def change_activity_points(update:Update, context):
     points = update.message.text
     activity_id = context.user_data[ACTIVITY]
@@ -631,14 +682,14 @@ def change_activity_points(update:Update, context):
         return update_activity(update, context)
     else:
         activity = get_activity_by_id(activity_id=activity_id)
-        activity.points = points
-        activity.save_activity()
+        update_activity_points(leaderboard_id=update.effective_chat.id, activity_id=activity_id, points=points)
         update.message.reply_text(
             f'Ok. Activity {activity.activity_name} gives {points} points 😎', 
             quote = False
         )
         return ConversationHandler.END 
 
+@unit_of_work
 def cancel(update:Update, context):
     #If command was triggered from inline keyboard submit
     query = update
@@ -646,13 +697,14 @@ def cancel(update:Update, context):
         query = update.callback_query
         query.answer()
 
-    query.message.reply_text(
+    reply(update,
         f'Ok. Bye 👋🏽',
         quote = False
     )
     return ConversationHandler.END 
 
 # /show_score - Shows Leaderboard score 
+@unit_of_work
 def show_score_command_handler(update:Update, context):
 
     #If command was triggered from inline keyboard submit
@@ -662,31 +714,299 @@ def show_score_command_handler(update:Update, context):
         query.answer()
 
     chat_id = update.effective_chat.id
+
+    # Inline keyboard button shows all time score
+    window = context.args[0].lower() if context.args else 'all'
+    if window not in SCORE_WINDOWS:
+        reply(update,
+            f"Usage: /show_score {'|'.join(SCORE_WINDOWS)}",
+            quote = False
+        )
+        return ConversationHandler.END
     
-    score = get_leaderboard_score(leaderboard_id = chat_id)
-    score_message = ''
-    if score:
-        for indx, row in enumerate(score):
-            score_message+= f"{'🥇 ' if indx == 0 else ''}" + f"{row['name']}" +' - '+ f"{row['points']}" + '💎\n  '
-        query.message.reply_text(
+    score_message = render_score(chat_id, window)
+    if score_message:
+        reply(update,
             score_message,
             quote = False
         )
     else:
-        query.message.reply_text(
+        reply(update,
             f'Leaderboard has not started. Send /start to enter the Leaderboard🏆'
         )
 
     return ConversationHandler.END 
 
+def render_score(chat_id:int, window:str='all'):
+    """
+    Score text of the Leaderboard for 'week', 'month' or 'all' time. Empty if there are no participants
+    """
+    since = score_window_start(chat_id, window)
+    # Window start is part of the key, the week and month roll over without writes
+    key = (chat_id, 'score', window, since, get_leaderboard_version(chat_id))
+    return rendered_cache.get_or_load(key, lambda: _render_score(chat_id, window, since))
+
+def _render_score(chat_id:int, window:str, since):
+    if since is None:
+        # All time score is served from the rank index
+        index = get_rank_index(chat_id)
+        # Waiting taps can move anyone into the top
+        score = [row._asdict() for row in index.top(len(index) if write_behind else SCORE_TOP_N)]
+    else:
+        score = get_leaderboard_score(leaderboard_id = chat_id, since = since)
+    if write_behind:
+        # Points of executions not saved yet
+        score = write_behind.overlay_score(chat_id, score)
+    if not score:
+        return ''
+    header = f'This {window}:\n  ' if since else ''
+    message = header + ''.join(
+        f"{'🥇 ' if indx == 0 else ''}{row['name']} - {row['points']}💎\n  " for indx, row in enumerate(score[:SCORE_TOP_N])
+    )
+    participants = len(index) if since is None else len(score)
+    if participants > SCORE_TOP_N:
+        message += f'...and {participants - SCORE_TOP_N} more. /my_rank shows your place\n'
+    return message
+
+# /my_rank - Place of the user in the Leaderboard, neighbours and gap to the first place
+@unit_of_work
+def my_rank_command_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+
+    # Rank is computed from saved scores
+    if write_behind:
+        write_behind.flush()
+    rank = get_rank_index(chat_id).rank(user.id)
+    if rank is None:
+        update.message.reply_text(
+            f'You are not in the Leaderboard yet. Send /start to enter the Leaderboard🏆',
+            quote = False
+        )
+        return
+
+    message = f'@{user.username}, you are #{rank.rank} of {rank.participants} with {rank.points}💎\n'
+    if rank.above:
+        message += f'  ⬆️ {rank.above.name} - {rank.above.points}💎 (+{rank.above.points - rank.points})\n'
+    if rank.below:
+        message += f'  ⬇️ {rank.below.name} - {rank.below.points}💎\n'
+    if rank.gap_to_first:
+        message += f'{rank.gap_to_first}💎 to the first place'
+    else:
+        message += '🥇 You are the leader'
+    update.message.reply_text(
+        message,
+        quote = False
+    )
+
+# /global_top - Top chats and users of the newest global snapshot
+@unit_of_work
+def global_top_command_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+    snapshot = get_global_top(GLOBAL_TOP_N)
+    if snapshot is None:
+        update.message.reply_text(
+            'Global scores are not computed yet. Try again later ⏳',
+            quote = False
+        )
+        return
+
+    message = '🌍 Top chats\n'
+    for indx, row in enumerate(snapshot.leaderboards):
+        message += f"  {indx + 1}. {row['name']} - {row['points']}💎 ({row['participants']} participants)\n"
+    rank = get_global_leaderboard_rank(snapshot_id = snapshot.id, leaderboard_id = chat_id)
+    if rank:
+        message += f'  This chat is #{rank[0]} of {rank[1]}\n'
+    message += '\n🌍 Top users\n'
+    for indx, row in enumerate(snapshot.users):
+        message += f"  {indx + 1}. {row['name']} - {row['points']}💎 in {row['leaderboards']} chat(s)\n"
+    message += f'\nUpdated {snapshot.time_completed:%m-%d %H:%M} UTC'
+    update.message.reply_text(
+        message,
+        quote = False
+    )
+
+def in_worker(func):
+    """
+    Decorator to run a long handler in a run_async worker, so the dispatcher thread keeps taking
+    updates of other chats. Sharded and asyncio dispatchers have no workers and already run handlers
+    off that thread, there the handler runs directly
+    """
+    @functools.wraps(func)
+    def inner(update:Update, context):
+        if context.dispatcher.workers:
+            return context.dispatcher.run_async(func, update, context)
+        return func(update, context)
+
+    return inner
+
+# /export - Full history of Executed Activities as gzip-compressed CSV or JSON Lines document.
+# Not a unit of work: history is streamed in its own session, no connection is held during upload
+@in_worker
+def export_command_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+
+    format = context.args[0].lower() if context.args else 'csv'
+    if format not in EXPORT_FORMATS:
+        update.message.reply_text(
+            f"Usage: /export {'|'.join(EXPORT_FORMATS)}",
+            quote = False
+        )
+        return
+
+    # Export includes only saved executions
+    if write_behind:
+        write_behind.flush()
+    with tempfile.TemporaryFile() as file:
+        rows = write_export(chat_id, file, format = format)
+        if not rows:
+            update.message.reply_text(
+                'No Activities Performed yet 🤷🏻',
+                quote = False
+            )
+            return
+        if file.tell() > EXPORT_MAX_BYTES:
+            update.message.reply_text(
+                f'Export is too large to send ({file.tell() // (1024 * 1024)} MB) 🤷🏻',
+                quote = False
+            )
+            return
+        file.seek(0)
+        context.bot.send_document(
+            chat_id = chat_id,
+            document = file,
+            filename = export_filename(chat_id, format),
+            caption = f'{rows} Executed Activities 📦'
+        )
+
+# CSV document with /import caption - Bulk import of Activities and Executed Activities.
+# Not a unit of work: executions are inserted in chunked transactions
+@in_worker
+def import_document_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    document = update.message.document
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        update.message.reply_text(
+            f'File is too large to import, up to {IMPORT_MAX_BYTES // (1024 * 1024)} MB is supported 🤷🏻',
+            quote = False
+        )
+        return
+
+    with tempfile.NamedTemporaryFile() as file:
+        document.get_file().download(out = file)
+        file.flush()
+        try:
+            report = import_history(file.name, chat_id, leaderboard_name = get_leaderboard_name(update),
+                                    author_user_id = user.id, author_name = user.username)
+        except ImportFormatError as e:
+            update.message.reply_text(
+                f'Could not import {document.file_name}: {e} 🤷🏻',
+                quote = False
+            )
+            return
+
+    message = (f'📥 Imported {report.executions} Executed Activities and {report.activities} new Activities '
+               f'from {report.rows} rows in {report.seconds:.1f}s\n')
+    if report.duplicates:
+        message += f'{report.duplicates} rows were imported before\n'
+    if report.errors:
+        message += f'{report.errors} rows have errors:\n'
+        message += ''.join(f'  line {line}: {error}\n' for line, error in report.error_rows[:10])
+    update.message.reply_text(
+        message[:4096],
+        quote = False
+    )
+
+# /activity_stats - Who executed each Activity last and how often Activities are executed
+@unit_of_work
+def activity_stats_command_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+
+    # Stats include only saved executions
+    if write_behind:
+        write_behind.flush()
+    stats = get_activity_stats(chat_id)
+    if not stats:
+        update.message.reply_text(
+            'No Activities Performed yet 🤷🏻',
+            quote = False
+        )
+        return
+
+    names = get_user_names(chat_id)
+    message = ''
+    # Most executed Activities that fit one page
+    for activity_stats in stats[:ACTIVITY_PAGE_SIZE]:
+        overall = activity_stats.overall
+        message += (f'📊 {activity_stats.name} - {overall.executions} times, '
+                    f'last by {names.get(overall.last_user_id, "?")} {overall.last_time:%m-%d %H:%M}\n'
+                    f'{format_rates(overall)}\n')
+        for user_stats in activity_stats.per_user:
+            message += f'  {names.get(user_stats.user_id, "?")} - {user_stats.executions} times, {format_rates(user_stats)}\n'
+    update.message.reply_text(
+        message[:4096],
+        quote = False
+    )
+
+def format_rates(execution_stats):
+    """
+    Average interval and frequency of executions
+    """
+    rates = f'{execution_stats.per_week:.1f}/week, {execution_stats.per_month:.1f}/month'
+    if not math.isnan(execution_stats.mean_interval_days):
+        rates = f'every {execution_stats.mean_interval_days:.1f} days, ' + rates
+    return rates
+
+# /set_timezone - Chat timezone for week and month scores
+@unit_of_work
+def set_timezone_command_handler(update:Update, context):
+    chat_id = update.effective_chat.id
+    if not context.args:
+        update.message.reply_text(
+            f'Timezone of this chat is {get_leaderboard_timezone(chat_id)}.\n'
+            f'Send /set_timezone Area/City to change it, e.g. /set_timezone Europe/Kiev',
+            quote = False
+        )
+        return
+    try:
+        timezone = set_leaderboard_timezone(leaderboard_id = chat_id, timezone = context.args[0])
+    except pytz.UnknownTimeZoneError:
+        update.message.reply_text(
+            f'Unknown timezone {context.args[0]} 🤷🏻. Use Area/City, e.g. Europe/Kiev',
+            quote = False
+        )
+        return
+    update.message.reply_text(
+        f'Ok. Week and month scores use {timezone} 🕰',
+        quote = False
+    )
+
+def render_log(chat_id:int):
+    """
+    Text of last 10 Executed Activities
+    """
+    key = (chat_id, 'log', get_leaderboard_version(chat_id))
+    return rendered_cache.get_or_load(key, lambda: _render_log(chat_id))
+
+def _render_log(chat_id:int):
+    log = get_leaderboard_log(leaderboard_id = chat_id, count = 10)
+    if not log:
+        return 'No Activities Performed yet 🤷🏻'
+    return ''.join(
+        f"{row['name']} - {row['activity_name']} -- {row['points']}💎 -- {row['time_created']:%m-%d %H:%M}\n" for row in log
+    )
+
 # /show_activities - Shows Leaderboard's Activityes 
+@unit_of_work
 def show_activities_command_handler(update:Update, context):
 
     leaderboard_id = update.effective_chat.id
-    # Get leaderboard activities 
-    activities = get_leaderboard_activities(leaderboard_id = leaderboard_id)
+    # Get first page of leaderboard activities 
+    page = get_activities_page(leaderboard_id)
     
-    if activities.count() < 1:
+    if not page.activities:
         # Telegram clients will display a reply interface to the user 
         # (act as if the user has selected the bot’s message and tapped ‘Reply’) 
         
@@ -695,15 +1015,44 @@ def show_activities_command_handler(update:Update, context):
             'Send /start or /add_activity command to add first activity'
         )
     else:
-        message = f"There {'is' if activities.count() == 1 else 'are'} {activities.count()} Activit{'y' if activities.count() == 1 else 'ies'}:\n"
-        for indx, act in enumerate(activities):
-            message += f'{indx+1}. {act.activity_name} ➖ {act.points} 💎\n'
+        message, keyboard_markup = render_activities_page(page, FIRST_PAGE)
         update.message.reply_text(
-            message 
+            message, reply_markup=keyboard_markup
         )
     return ConversationHandler.END
 
+# Prev/next buttons of /show_activities. Handled outside of the conversation
+@unit_of_work
+def show_activities_page(update:Update, context):
+    query = update.callback_query
+    query.answer()
+
+    # activities_<after_id>_<before_id>_<offset>
+    after_id, before_id, offset = (int(value) if value else None for value in query.data.split('_')[1:])
+    page_ref = ActivityPageRef(after_id, before_id, offset)
+    page = get_activities_page(update.effective_chat.id, after_id=after_id, before_id=before_id)
+
+    message, keyboard_markup = render_activities_page(page, page_ref)
+    query.edit_message_text(message, reply_markup=keyboard_markup)
+
+def render_activities_page(page, page_ref:ActivityPageRef):
+    """
+    Text and prev/next keyboard of /show_activities page
+    """
+    if page_ref.offset == 0 and not page.has_next:
+        count = len(page.activities)
+        message = f"There {'is' if count == 1 else 'are'} {count} Activit{'y' if count == 1 else 'ies'}:\n"
+    else:
+        message = f'Activities {page_ref.offset + 1}-{page_ref.offset + len(page.activities)}:\n'
+    for indx, act in enumerate(page.activities):
+        message += f'{page_ref.offset + indx + 1}. {act.activity_name} ➖ {act.points} 💎\n'
+
+    navigation = page_navigation(page, page_ref, lambda text, ref: InlineKeyboardButton(
+        text, callback_data=f"activities_{ref.after_id or ''}_{ref.before_id or ''}_{ref.offset}"))
+    return message, InlineKeyboardMarkup([navigation]) if navigation else None
+
 # /show_log - Show last 10 Executed Activities
+@unit_of_work
 def show_log_command_handler(update:Update, context):
     #If command was triggered from inline keyboard submit
     query = update
@@ -713,19 +1062,16 @@ def show_log_command_handler(update:Update, context):
 
     leaderboard_id = update.effective_chat.id
 
-    log = get_leaderboard_log(leaderboard_id = leaderboard_id, count = 10)
-
-    message = ''
-    if log.rowcount > 0: 
-        for row in log: 
-            message += f"{row['name']} - {row['activity_name']} -- {row['points']}💎 -- {row['time_created']:%m-%d %H:%M}\n"
-    else: 
-        message = 'No Activities Performed yet 🤷🏻'
+    # Log shows only saved executions
+    if write_behind:
+        write_behind.flush()
+    message = render_log(leaderboard_id)
 
-    query.message.reply_text(message, quote = False)
+    reply(update, message, quote = False)
 
     return ConversationHandler.END
 
+@unit_of_work
 def cancel_activity_command_handler(update:Update, context):
     
     #If command was triggered from inline keyboard submit
@@ -737,22 +1083,25 @@ def cancel_activity_command_handler(update:Update, context):
     user_id = update.effective_user.id
     leaderboard_id = update.effective_chat.id
 
-    activities = get_performed_activities(user_id = user_id, leaderboard_id = leaderboard_id)
+    # Executions are canceled by id, which they get when saved
+    if write_behind:
+        write_behind.flush()
+    activities = get_recent_activities(user_id = user_id, leaderboard_id = leaderboard_id)
     
     message = ''
-    if activities.rowcount > 0:
+    if len(activities) > 0:
         keyboard = []
         # Should end interaction with bot 
         for indx, act in enumerate(activities):
-            key = [InlineKeyboardButton(f"{act['name']} - {act['time']:%m-%d %H:%M}", callback_data=f"{indx}_{act['id']}")]
+            key = [choice_button(f"{act.name} - {act.time:%m-%d %H:%M}", indx, act)]
             keyboard.append(key)
         
-        key = [InlineKeyboardButton(f'❌ Cancel', callback_data=f"{activities.rowcount}_{-1}")]
+        key = [choice_button(f'❌ Cancel', len(activities))]
         keyboard.append(key)
 
-        keyboard_markup = InlineKeyboardMarkup(keyboard)
+        keyboard_markup = choice_markup(keyboard)
         
-        query.message.reply_text(
+        reply(update,
             f'What Acitivity you would like to cancel?', reply_markup=keyboard_markup,
             quote = False
         )
@@ -760,39 +1109,32 @@ def cancel_activity_command_handler(update:Update, context):
 
     else:
         message = 'You have no executed activities yet 🤷🏻'
-        query.message.reply_text(message, quote = False)
+        reply(update, message, quote = False)
         return ConversationHandler.END
 
 
+@unit_of_work
 def cancel_activity(update: Update, context):
     query = update.callback_query
     query.answer()
 
-    button_id, performed_activity_id = query.data.split('_')
-    performed_activity_id = int(performed_activity_id)
-    button_id = int(button_id)
+    choice = callback_registry.resolve(query.data)
+    if choice is None:
+        return menu_expired(update, context)
+    button_id, executed = choice
 
-    #Remove Inline Keyboard
-    query.edit_message_reply_markup(
-        None
-    )
+    #Remove Inline Keyboard, send user choice as a message
+    close_menu(update, query.message.reply_markup.inline_keyboard[button_id][0].text)
 
-    query.message.reply_text(
-            query.message.reply_markup.inline_keyboard[button_id][0].text, 
-            quote = False
-        )
-
-    if performed_activity_id == -1:
+    if executed is None:
         return cancel(update, context)
 
     #Delete performed activity from the database
-    performed_activity = get_performed_activity_by_id(id=performed_activity_id)
-    activity = get_activity_by_id(activity_id=performed_activity.activity_id)
-    performed_activity.delete_performed_activity()
+    delete_performed_activity_by_id(id=executed.id)
 
 
-    query.message.reply_text(
-            f"{activity.activity_name} - {performed_activity.time_created:%m-%d %H:%M} was canceled ❌",
+    reply(update,
+            f"{executed.name} - {executed.time:%m-%d %H:%M} was canceled ❌",
             quote = False
         )
     
@@ -800,26 +1142,21 @@ def cancel_activity(update: Update, context):
     return ConversationHandler.END
 
 
-def main():
-
-    env = os.environ.get('ENV')
-    webhook_url = os.environ.get('WEBHOOK_URL')
-    port = os.environ.get('PORT_T')
-    mode = os.environ.get('MODE')
-
-    if env == "GCLOUD":
-        project_id = os.environ.get('GCLOUD_PROJECT_ID')
-        logging.info(os.environ.get('GCLOUD_PROJECT_ID'))
-
-        gcl = gcloud.Gcloud(project_id)
-        token = gcl.access_secret_version()
-    else:
-        token = os.environ.get("TOKEN")
-
-    #Create Updater
-    updater = Updater(token=token, use_context=True)
-    
-    conv_handler = ConversationHandler(
+def add_handlers(dispatcher, persistent:bool=False):
+    # Goes before the conversation, which takes every callback query in its states
+    dispatcher.add_handler(CallbackQueryHandler(show_activities_page, pattern='^activities_'))
+    dispatcher.add_handler(CommandHandler('set_timezone', set_timezone_command_handler))
+    dispatcher.add_handler(CommandHandler('activity_stats', activity_stats_command_handler))
+    dispatcher.add_handler(CommandHandler('my_rank', my_rank_command_handler))
+    dispatcher.add_handler(CommandHandler('global_top', global_top_command_handler))
+    dispatcher.add_handler(CommandHandler('export', export_command_handler))
+    dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption(['/import']), import_document_handler))
+    dispatcher.add_handler(build_conversation_handler(persistent=persistent))
+
+def build_conversation_handler(persistent:bool=False):
+    return ConversationHandler(
+        name='leaderboard',
+        persistent=persistent,
         entry_points=[CommandHandler('start', start),
                      CommandHandler('add_activity', add_activity_command_handler), 
                      CommandHandler('execute_activity', execute_activity_command_handler), 
@@ -852,33 +1189,140 @@ def main():
                  CommandHandler('cancel_activity',cancel_activity_command_handler),
                  CommandHandler('update_activity',update_activity_command_handler)]
     )
-    
-    #Create Dispatcher
-    disp = updater.dispatcher
 
-    #Add handlers to updater
-    disp.add_handler(conv_handler)
+
+def log_stats(outbox:Outbox=None):
+    """
+    Log counters collected by the model, caches and outbox. Runs every STATS_INTERVAL seconds
+    """
+    logger.info(f'Pool stats: {get_pool_stats()}')
+    logger.info(f'Query stats: {get_query_stats()}')
+    logger.info(f'Cache stats: activities {activity_cache.stats()}, rendered {rendered_cache.stats()}')
+    if outbox:
+        logger.info(f'Outbox stats: {outbox.get_stats()}')
+
+def main():
+    global write_behind
+
+    env = os.environ.get('ENV')
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    port = os.environ.get('PORT_T')
+    mode = os.environ.get('MODE')
+    runtime = os.environ.get('RUNTIME')
+
+    if env == "GCLOUD":
+        project_id = os.environ.get('GCLOUD_PROJECT_ID')
+        logging.info(os.environ.get('GCLOUD_PROJECT_ID'))
+
+        gcl = gcloud.Gcloud(project_id)
+        token = gcl.access_secret_version()
+    else:
+        token = os.environ.get("TOKEN")
 
     #Init database
     init_db() 
 
-    if mode == 'webhook':
-        #Start polling from Telegram
-        updater.start_webhook(listen='0.0.0.0',
-                        port=port,
-                        url_path=token)
-    else: 
-        updater.start_polling()
+    # Keep conversation states and user_data in db between restarts and instances
+    persistence = None
+    if os.environ.get('PERSISTENCE') == 'sql':
+        persistence = SQLPersistence(flush_interval=float(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', 5)),
+                                     ttl=float(os.environ.get('PERSISTENCE_TTL', 7 * 24 * 3600)))
+        persistence.start()
+
+    # Execution taps are acknowledged after a local journal write and saved in batches
+    if os.environ.get('WRITE_BEHIND') == '1':
+        write_behind = WriteBehindJournal(os.environ.get('WRITE_BEHIND_JOURNAL', 'taps.journal'),
+                                          flush_interval=int(os.environ.get('WRITE_BEHIND_FLUSH_MS', 200)) / 1000,
+                                          batch_size=int(os.environ.get('WRITE_BEHIND_BATCH', 200)))
+        write_behind.start()
+
+    # Snapshot of chat and user totals across all Leaderboards for /global_top
+    global_scores = None
+    global_refresh_interval = int(os.environ.get('GLOBAL_REFRESH_INTERVAL', 3600))
+    if global_refresh_interval > 0:
+        global_scores = PeriodicJob('global_scores', global_refresh_interval, refresh_global_scores)
+        global_scores.start()
+
+    # Rate limited outgoing queue, merges consecutive replies to one chat
+    outbox = None
+    if os.environ.get('OUTBOX') == '1':
+        outbox = Outbox(global_rate=float(os.environ.get('OUTBOX_GLOBAL_RATE', 30)),
+                        chat_rate=float(os.environ.get('OUTBOX_CHAT_RATE', 1)),
+                        group_rate=float(os.environ.get('OUTBOX_GROUP_RATE', 20 / 60)),
+                        coalesce_window=float(os.environ.get('OUTBOX_COALESCE_WINDOW', 0.15)),
+                        senders=int(os.environ.get('OUTBOX_SENDERS', 8)))
+        outbox.start()
+
+    stats = None
+    if STATS_INTERVAL > 0:
+        stats = PeriodicJob('stats', STATS_INTERVAL, lambda: log_stats(outbox), delay=STATS_INTERVAL)
+        stats.start()
+
+    if runtime == 'asyncio':
+        # Updates are handled on an asyncio loop with bounded handler and sender pools.
+        # Polling only
+        # One handler thread per db connection the pool can open
+        aio = AsyncioRuntime(token, workers=int(os.environ.get('HANDLER_WORKERS', db_pool_size + db_max_overflow)),
+                             send_concurrency=int(os.environ.get('SEND_CONCURRENCY', 16)),
+                             persistence=persistence, outbox=outbox,
+                             max_pending=int(os.environ.get('MAX_PENDING_UPDATES', 0)) or None)
+        add_handlers(aio.dispatcher, persistent=persistence is not None)
+        aio.run()
+    else:
+        #Create Updater
+        if os.environ.get('DISPATCHER') == 'sharded':
+            # Updates of one chat are processed in order, different chats in parallel
+            shards = int(os.environ.get('SHARDS', 8))
+            request = UnitOfWorkRequest(con_pool_size=shards + (outbox.senders if outbox else 0) + 4)
+            bot = QueuedBot(token, outbox, request=request) if outbox else telegram.Bot(token, request=request)
+            job_queue = JobQueue()
+            dispatcher = ShardedDispatcher(bot, Queue(), shards=shards,
+                                           queue_depth=int(os.environ.get('SHARD_QUEUE_DEPTH', 100)),
+                                           stats_interval=float(os.environ.get('SHARD_STATS_INTERVAL', 60)),
+                                           job_queue=job_queue, persistence=persistence, use_context=True)
+            job_queue.set_dispatcher(dispatcher)
+            updater = Updater(dispatcher=dispatcher, workers=None, use_context=True)
+        elif outbox:
+            bot = QueuedBot(token, outbox, request=UnitOfWorkRequest(con_pool_size=outbox.senders + 8))
+            updater = Updater(bot=bot, persistence=persistence, use_context=True)
+        else:
+            # Pool size Updater gives its own bot: 4 run_async workers + 4
+            bot = telegram.Bot(token, request=UnitOfWorkRequest(con_pool_size=8))
+            updater = Updater(bot=bot, persistence=persistence, use_context=True)
 
-    updater.idle()
+        #Add handlers to updater
+        add_handlers(updater.dispatcher, persistent=persistence is not None)
 
+        if mode == 'webhook':
+            #Start polling from Telegram
+            updater.start_webhook(listen='0.0.0.0',
+                            port=port,
+                            url_path=token)
+        else: 
+            updater.start_polling()
 
+        updater.idle()
 
+    if outbox:
+        outbox.stop()
 
-if __name__ == "__main__":
-    main() 
+    if global_scores:
+        global_scores.stop()
+
+    if stats:
+        stats.stop()
+
+    if write_behind:
+        write_behind.stop()
 
+    if persistence:
+        persistence.stop()
 
+    #Close pooled db connections
+    dispose_engine()
 
 
 
+
+if __name__ == "__main__":
+    main() 
@@ -0,0 +1,140 @@
+import argparse
+import logging
+import sys
+import time
+
+from model import (init_db, rebuild_participant_scores, verify_participant_scores, explain_log_queries,
+                   refresh_global_scores, GLOBAL_CHUNK_SIZE)
+from export import EXPORT_FORMATS, export_filename, write_export
+from importer import import_history, ImportFormatError
+
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+
+logger = logging.getLogger(__name__)
+
+# Maintenance commands:
+# python manage.py scores rebuild [--leaderboard CHAT_ID]   (also rebuilds daily_executions)
+# python manage.py scores verify [--leaderboard CHAT_ID]
+# python manage.py explain --leaderboard CHAT_ID --user USER_ID
+# python manage.py global refresh [--chunk-size N]
+# python manage.py export --leaderboard CHAT_ID [--format csv|jsonl] [--output FILE]
+# python manage.py import --leaderboard CHAT_ID FILE [--name CHAT_NAME] [--chunk-size N]
+
+
+def scores(args):
+    """
+    Rebuild or verify materialized participant scores
+    """
+    if args.action == 'rebuild':
+        rows = rebuild_participant_scores(leaderboard_id=args.leaderboard)
+        logger.info(f'Rebuilt {rows} participant score(s)')
+        return 0
+
+    mismatches = verify_participant_scores(leaderboard_id=args.leaderboard)
+    for participant_id, stored, actual in mismatches:
+        logger.error(f'Participant {participant_id}: stored {stored}, actual {actual}')
+    if mismatches:
+        logger.error(f'{len(mismatches)} participant score(s) do not match history. Run: scores rebuild')
+        return 1
+    logger.info('Participant scores match history')
+    return 0
+
+
+def explain(args):
+    """
+    Fail if log queries regressed to a full scan or filesort of performed_activity
+    """
+    problems = explain_log_queries(leaderboard_id=args.leaderboard, user_id=args.user)
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        return 1
+    logger.info('Log queries use indexes')
+    return 0
+
+
+def global_scores(args):
+    """
+    Write a new snapshot of chat and user totals for /global_top
+    """
+    started = time.monotonic()
+    snapshot = refresh_global_scores(chunk_size=args.chunk_size)
+    logger.info(f'Snapshot {snapshot.id}: {snapshot.leaderboards} chat(s), {snapshot.users} user(s) '
+                f'in {time.monotonic() - started:.1f}s')
+    return 0
+
+
+def export(args):
+    """
+    Write gzip-compressed execution history of the chat to a file
+    """
+    output = args.output or export_filename(args.leaderboard, args.format)
+    started = time.monotonic()
+    with open(output, 'wb') as file:
+        rows = write_export(args.leaderboard, file, format=args.format, batch_size=args.batch_size)
+    elapsed = time.monotonic() - started
+    logger.info(f'Exported {rows} row(s) to {output} in {elapsed:.1f}s')
+    return 0
+
+
+def import_file(args):
+    """
+    Load Activities and executions from a CSV file (plain or gzip) into a chat
+    """
+    try:
+        report = import_history(args.file, args.leaderboard, leaderboard_name=args.name, chunk_size=args.chunk_size)
+    except ImportFormatError as e:
+        logger.error(f'{args.file}: {e}')
+        return 1
+    for line, error in report.error_rows:
+        logger.error(f'Line {line}: {error}')
+    logger.info(f'{report.rows} row(s) in {report.seconds:.1f}s ({report.rows / max(report.seconds, 0.001):.0f} rows/s). '
+                f'Created {report.activities} Activity(ies), imported {report.executions} execution(s), '
+                f'skipped {report.duplicates} imported before, {report.errors} error row(s)')
+    return 1 if report.errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Leaderboard bot maintenance')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scores_parser = commands.add_parser('scores', help='Materialized participant scores')
+    scores_parser.add_argument('action', choices=['rebuild', 'verify'])
+    scores_parser.add_argument('--leaderboard', type=int, help='Chat id. All leaderboards if omitted')
+    scores_parser.set_defaults(func=scores)
+
+    explain_parser = commands.add_parser('explain', help='Check query plans of the log queries')
+    explain_parser.add_argument('--leaderboard', type=int, required=True, help='Chat id')
+    explain_parser.add_argument('--user', type=int, required=True, help='Telegram user id')
+    explain_parser.set_defaults(func=explain)
+
+    global_parser = commands.add_parser('global', help='Global scores across all leaderboards')
+    global_parser.add_argument('action', choices=['refresh'])
+    global_parser.add_argument('--chunk-size', type=int, default=GLOBAL_CHUNK_SIZE,
+                               help='Chats or users aggregated per transaction')
+    global_parser.set_defaults(func=global_scores)
+
+    export_parser = commands.add_parser('export', help='Export execution history of a chat')
+    export_parser.add_argument('--leaderboard', type=int, required=True, help='Chat id')
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--output', help='File name. leaderboard_CHAT_ID.FORMAT.gz if omitted')
+    export_parser.add_argument('--batch-size', type=int, default=1000, help='Rows fetched from the cursor at a time')
+    export_parser.set_defaults(func=export)
+
+    import_parser = commands.add_parser('import', help='Import Activities and executions from CSV')
+    import_parser.add_argument('file', help='CSV with columns time_created, user_id, user, activity, points. May be gzipped')
+    import_parser.add_argument('--leaderboard', type=int, required=True, help='Chat id')
+    import_parser.add_argument('--name', help='Chat name if the leaderboard does not exist yet')
+    import_parser.add_argument('--chunk-size', type=int, default=1000, help='Executions inserted per transaction')
+    import_parser.set_defaults(func=import_file)
+
+    args = parser.parse_args(argv)
+
+    init_db()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
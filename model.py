@@ -1,11 +1,24 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, BigInteger, DateTime, ForeignKey
-from sqlalchemy.orm import (sessionmaker, relationship, backref)
-from sqlalchemy import create_engine, engine
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Text, BigInteger, DateTime, Date, ForeignKey, UniqueConstraint, Index
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import (sessionmaker, scoped_session, relationship, backref)
+from sqlalchemy import create_engine, engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import func, select, exists, and_, or_, literal
 import os
 import logging
+import threading
+import time
+import atexit
+import functools
+from contextlib import contextmanager
 import gcloud
+import queries
+from ranking import RankIndex
+from cache import LRUCache, VersionCounter, RingBuffers
+from collections import namedtuple, Counter
+from datetime import datetime, timedelta
+import pytz
 import pymysql 
 
 
@@ -16,7 +29,10 @@ db_name = os.environ.get("DB_NAME")
 host = os.environ.get("HOST")
 port = os.environ.get("DB_PORT")
 
-if env == "GCLOUD":
+if os.environ.get("DB_URL"):
+    # Local runs, e.g. sqlite:///leaderboard.db
+    url = engine.url.make_url(os.environ.get("DB_URL"))
+elif env == "GCLOUD":
     cloud_sql_connection_name = os.environ.get("CLOUD_SQL_CONNECTION_NAME")
     project_id = os.environ.get('GCLOUD_PROJECT_ID')
     gcl = gcloud.Gcloud(project_id)
@@ -51,7 +67,168 @@ logger = logging.getLogger()
 
 Base = declarative_base()
 
+# BIGINT primary keys are not autoincremented by SQLite, only INTEGER ones
+BigIntegerId = BigInteger().with_variant(Integer, 'sqlite')
 
+# Per-chat activity catalogs. Invalidated after commit of every write to activities
+activity_cache = LRUCache(maxsize=int(os.environ.get("ACTIVITY_CACHE_SIZE", 1024)),
+                          ttl=int(os.environ.get("ACTIVITY_CACHE_TTL", 3600)))
+
+ActivityRow = namedtuple('ActivityRow', ['id', 'activity_name', 'points'])
+ActivityPage = namedtuple('ActivityPage', ['activities', 'has_prev', 'has_next'])
+
+ACTIVITY_PAGE_SIZE = int(os.environ.get("ACTIVITY_PAGE_SIZE", 10))
+
+# Per-leaderboard version of activities. Part of cached page keys,
+# so pages loaded before a write are never served after it
+activity_versions = VersionCounter()
+
+# Last performed activities per (user_id, leaderboard_id), for /cancel_activity menus
+RECENT_ACTIVITIES_SIZE = int(os.environ.get("RECENT_ACTIVITIES_SIZE", 10))
+recent_activities = RingBuffers(size=RECENT_ACTIVITIES_SIZE, maxkeys=int(os.environ.get("RECENT_ACTIVITIES_USERS", 10000)))
+
+RecentActivity = namedtuple('RecentActivity', ['id', 'name', 'time'])
+
+# Chat timezones, used for day buckets of daily_executions
+timezone_cache = LRUCache(maxsize=int(os.environ.get("TIMEZONE_CACHE_SIZE", 1024)),
+                          ttl=int(os.environ.get("TIMEZONE_CACHE_TTL", 3600)))
+
+# Per-leaderboard RankIndex, seeded from participant_scores and moved after commit of score changes.
+# Writes that change many scores make it reload
+rank_indexes = LRUCache(maxsize=int(os.environ.get("RANK_INDEX_SIZE", 1024)),
+                        ttl=int(os.environ.get("RANK_INDEX_TTL", 600)))
+
+# Newest global snapshot. Cleared by refresh_global_scores(), other processes see it within TTL
+global_cache = LRUCache(maxsize=16, ttl=int(os.environ.get("GLOBAL_CACHE_TTL", 60)))
+GLOBAL_CHUNK_SIZE = int(os.environ.get("GLOBAL_CHUNK_SIZE", 1000))
+
+GlobalSnapshot = namedtuple('GlobalSnapshot', ['id', 'time_completed', 'leaderboards', 'users'])
+
+# Per-leaderboard version. Bumped after commit of every write that changes score or log
+leaderboard_versions = VersionCounter()
+
+
+
+
+# Pool settings. Defaults are sized for a single bot process
+pool_size = int(os.environ.get("DB_POOL_SIZE", 5))
+max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+pool_timeout = int(os.environ.get("DB_POOL_TIMEOUT", 30))  # 30 seconds
+pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # 30 minutes
+pool_pre_ping = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+
+# Process-wide engine. Created on first use by get_engine()
+_engine = None
+_engine_lock = threading.Lock()
+
+# Thread-local session registry. Bound to the engine by get_engine()
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+# Current unit of work of the thread: nesting depth and connections held
+_scope = threading.local()
+
+# Pool checkout/wait metrics
+pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'wait_total': 0.0,
+    'wait_max': 0.0,
+    'units_of_work': 0,
+    'max_connections_per_unit': 0,
+}
+_stats_lock = threading.Lock()
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that records how long callers wait for a connection
+    """
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.monotonic() - started
+            with _stats_lock:
+                pool_stats['wait_total'] += waited
+                pool_stats['wait_max'] = max(pool_stats['wait_max'], waited)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    with _stats_lock:
+        pool_stats['connects'] += 1
+    if url.drivername.startswith('sqlite'):
+        # ON DELETE CASCADE is ignored by SQLite unless enabled per connection
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _stats_lock:
+        pool_stats['checkouts'] += 1
+    if getattr(_scope, 'depth', 0):
+        _scope.connections += 1
+
+def _on_checkin(dbapi_connection, connection_record):
+    with _stats_lock:
+        pool_stats['checkins'] += 1
+
+
+def get_engine():
+    """
+    Returns process-wide engine, creates it on first call
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                connect_args = {}
+                if url.drivername.startswith('sqlite'):
+                    # Pooled connections are shared between dispatcher threads
+                    connect_args['check_same_thread'] = False
+                db = create_engine(
+            # Equivalent URL:
+            # mysql+pymysql://<db_user>:<db_pass>@/<db_name>?unix_socket=/cloudsql/<cloud_sql_instance_name>
+                    url,
+                    connect_args=connect_args,
+                    poolclass=MeteredQueuePool,
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_timeout=pool_timeout,
+                    pool_recycle=pool_recycle,
+                    pool_pre_ping=pool_pre_ping,
+                )
+                event.listen(db, 'connect', _on_connect)
+                event.listen(db, 'checkout', _on_checkout)
+                event.listen(db, 'checkin', _on_checkin)
+                Session.configure(bind=db)
+                _engine = db
+    return _engine
+
+def dispose_engine():
+    """
+    Close all pooled connections. Called on shutdown
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            logger.info(f'Disposing db engine. {get_pool_stats()}')
+            _engine.dispose()
+            _engine = None
+
+atexit.register(dispose_engine)
+
+def get_pool_stats():
+    """
+    Returns pool checkout/wait metrics together with current pool status
+    """
+    with _stats_lock:
+        stats = dict(pool_stats)
+    if stats['checkouts']:
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts']
+    if _engine is not None:
+        stats['status'] = _engine.pool.status()
+    return stats
 
 
 def ensure_connection(func):
@@ -59,35 +236,118 @@ def ensure_connection(func):
     Decorator to connect to db
     """
     def inner(*args, **kwargs):
-        db = create_engine(
-    # Equivalent URL:
-    # mysql+pymysql://<db_user>:<db_pass>@/<db_name>?unix_socket=/cloudsql/<cloud_sql_instance_name>
-            url,
-            pool_size=0,
-            max_overflow=10,
-            pool_timeout=30,  # 30 seconds
-            pool_recycle=1800,  # 30 minutes
-
-        )
-
-       
-        kwargs['db'] = db
+        kwargs['db'] = get_engine()
         res = func(*args, **kwargs)
         return res
 
     return inner
 
-@ensure_connection
-def establish_session(func, db):
+@contextmanager
+def session_scope():
+    """
+    Unit of work. Nested scopes reuse the outer session,
+    only the outermost scope commits or rolls back.
+    Callbacks of after_unit_of_work run once the outermost scope is committed and closed
+    """
+    get_engine()
+    if getattr(_scope, 'depth', 0):
+        _scope.depth += 1
+        try:
+            yield Session()
+        finally:
+            _scope.depth -= 1
+        return
+
+    _scope.depth = 1
+    _scope.connections = 0
+    _scope.after = []
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+        _scope.depth = 0
+        after, _scope.after = _scope.after, []
+        with _stats_lock:
+            pool_stats['units_of_work'] += 1
+            pool_stats['max_connections_per_unit'] = max(pool_stats['max_connections_per_unit'], _scope.connections)
+        logger.debug(f'Unit of work held {_scope.connections} db connection(s)')
+    # Not reached on rollback
+    for callback in after:
+        callback()
+
+def in_unit_of_work():
+    return bool(getattr(_scope, 'depth', 0))
+
+def after_unit_of_work(callback):
+    """
+    Run callback once the current unit of work is committed and its connection is back in the pool.
+    Dropped if the unit of work is rolled back
+    """
+    _scope.after.append(callback)
+
+def after_commit(session, callback):
+    """
+    Run callback once the unit of work of the session is committed
+    """
+    session.info.setdefault('after_commit', []).append(callback)
+
+def _run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+def _drop_after_commit(session):
+    session.info.pop('after_commit', None)
+
+event.listen(Session.session_factory, 'after_commit', _run_after_commit)
+event.listen(Session.session_factory, 'after_rollback', _drop_after_commit)
+
+def unit_of_work(func):
+    """
+    Decorator to run Telegram handler in a single session scope.
+    Its Telegram requests are sent after the scope (see runtime.UnitOfWorkRequest)
+    """
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with session_scope():
+            return func(*args, **kwargs)
+
+    return inner
+
+def establish_session(func):
     """
     Decorator to establish session.
-    Should be used only with ensure_connection decorator
+    Joins the current unit of work if there is one
     """
     def inner(*args, **kwargs):
-        Session = sessionmaker(bind=db)
-        session = Session()
-        kwargs['session'] = session
-        res = func(*args, **kwargs)
+        with session_scope() as session:
+            kwargs['session'] = session
+            res = func(*args, **kwargs)
+        return res
+
+    return inner
+
+def own_transaction(func):
+    """
+    Decorator to run function in a session of its own, committed before it returns
+    even if the calling thread is inside a unit of work
+    """
+    def inner(*args, **kwargs):
+        get_engine()
+        session = Session.session_factory()
+        try:
+            kwargs['session'] = session
+            res = func(*args, **kwargs)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
         return res
 
     return inner
@@ -95,21 +355,124 @@ def establish_session(func, db):
 @ensure_connection
 def init_db(db):
     Base.metadata.create_all(db)
+    _backfill_materialized_tables()
+
+@establish_session
+def _backfill_materialized_tables(session):
+    """
+    Tables maintained on write start empty on databases created before them.
+    Fill them from history on the first start, scores would read as 0 otherwise
+    """
+    ps = Participant_Score.__table__
+    p = Participant.__table__
+    if session.execute(select([ps.c.participant_id]).limit(1)).first() is None and \
+            session.execute(select([p.c.id]).limit(1)).first() is not None:
+        logger.info('Filling participant_scores from history')
+        _rebuild_scores(session)
+    de = Daily_Execution.__table__
+    pa = Performed_Activity.__table__
+    if session.execute(select([de.c.participant_id]).limit(1)).first() is None and \
+            session.execute(select([pa.c.id]).limit(1)).first() is not None:
+        logger.info('Filling daily_executions from history')
+        _rebuild_daily_executions(session)
+
+
+def _unique_keys(table, values:dict):
+    """
+    Returns columns of the first unique key (primary key first) fully present in values
+    """
+    keys = [table.primary_key] + [c for c in table.constraints if isinstance(c, UniqueConstraint)]
+    for key in keys:
+        names = [c.name for c in key.columns]
+        if all(values.get(name) is not None for name in names):
+            return names
+    return None
+
+def _upsert(session, table, values:dict, update:dict):
+    """
+    INSERT ... ON DUPLICATE KEY UPDATE in the current session.
+    On SQLite (local runs) UPDATE first and INSERT if row does not exist.
+    Returns primary key of the row without reloading it
+    """
+    pk = list(table.primary_key.columns)[0]
+    if session.get_bind().dialect.name == 'sqlite':
+        keys = _unique_keys(table, values)
+        if keys:
+            where = and_(*[table.c[name] == values[name] for name in keys])
+            if update:
+                session.execute(table.update().where(where).values(**update))
+            row_id = session.execute(select([pk]).where(where)).scalar()
+            if row_id is not None:
+                return row_id
+        return session.execute(table.insert().values(**values)).inserted_primary_key[0]
+
+    update = dict(update)
+    if pk.autoincrement is True:
+        # Makes lastrowid return id of the existing row as well
+        update[pk.name] = func.last_insert_id(pk)
+    elif not update:
+        update[pk.name] = pk
+    result = session.execute(mysql_insert(table).values(**values).on_duplicate_key_update(**update))
+    return values.get(pk.name) or result.lastrowid
+
+def _upsert_many(session, table, rows:list, update_columns:tuple):
+    """
+    Multi-row INSERT ... ON DUPLICATE KEY UPDATE in the current session.
+    On SQLite (local runs) rows are upserted one by one
+    """
+    if not rows:
+        return
+    if session.get_bind().dialect.name == 'sqlite':
+        for row in rows:
+            _upsert(session, table, row, {name: row[name] for name in update_columns})
+        return
+    stmt = mysql_insert(table).values(rows)
+    stmt = stmt.on_duplicate_key_update(**{name: stmt.inserted[name] for name in update_columns})
+    session.execute(stmt)
+
+def _insert_ignore(session, table, values):
+    """
+    INSERT IGNORE in the current session. values is a dict or a list of dicts (multi-row).
+    Returns number of inserted rows
+    """
+    prefix = 'OR IGNORE' if session.get_bind().dialect.name == 'sqlite' else 'IGNORE'
+    return session.execute(table.insert().prefix_with(prefix).values(values)).rowcount
 
 
-class Activity(Base):
+class Upsertable:
+    """
+    Write path for model classes. One upsert statement instead of session.merge(),
+    which does a SELECT by primary key before every INSERT/UPDATE
+    """
+    # Columns updated if the row already exists
+    upsert_columns = ()
+
+    def upsert(self, session):
+        table = self.__table__
+        values = {c.name: getattr(self, c.name) for c in table.columns if getattr(self, c.name) is not None}
+        update = {name: values[name] for name in self.upsert_columns if name in values}
+        if self in session:
+            # Do not let the unit of work flush the same changes again
+            session.expunge(self)
+        self.id = _upsert(session, table, values, update)
+        return self.id
+
+
+class Activity(Upsertable, Base):
     __tablename__ = 'activities'
+    upsert_columns = ('activity_name', 'points')
 
-    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    id = Column(BigIntegerId, primary_key=True, autoincrement=True)
     activity_name = Column(String(255))
     time_created = Column(DateTime(timezone=True), nullable=False, default=func.now() )
     points = Column(Integer)
 
     author_user_id = Column(BigInteger, ForeignKey('users.id'))
-    leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'))
+    leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'), index=True)
 
     # Relationships 
-    performed_activities = relationship("Performed_Activity", cascade="all, delete-orphan")
+    # Rows are deleted by ON DELETE CASCADE, not loaded to the session
+    performed_activities = relationship("Performed_Activity", cascade="all, delete-orphan", passive_deletes=True)
 
 
     def __init__(self, activity_name, points, author_user_id, leaderboard_id):
@@ -120,16 +483,12 @@ class Activity(Base):
 
     @establish_session
     def save_activity(self, session):
-        session.merge(self)
-        session.commit()
-        session.close()
+        activity_id = self.upsert(session)
+        _invalidate_activities(session, self.leaderboard_id)
+        return activity_id
 
-    @establish_session
-    def delete_activity(self, session):
-        activity = session.merge(self)
-        session.delete(activity)
-        session.commit()
-        session.close()
+    def delete_activity(self):
+        return delete_activity_by_id(activity_id=self.id)
 
     def __repr__(self):
         return "<Activity(activity_name='%s', time_created='%s', points='%s', author_user_id='%s')>" % (
@@ -137,8 +496,7 @@ class Activity(Base):
 
 @establish_session
 def get_activities_by_user_id(session, user_id:int):
-    result = session.query(Activity).filter_by(author_user_id=user_id)
-    session.close()
+    result = session.query(Activity).filter_by(author_user_id=user_id).all()
     return result
 
 @establish_session
@@ -146,12 +504,22 @@ def get_activity_by_id(session, activity_id:int):
     result = session.query(Activity).filter_by(id=activity_id).first() 
     return result
 
-@ensure_connection
+@establish_session
 def delete_activity_by_id(session, activity_id:int):
-    activity = session.query(Activity).filter_by(id=activity_id).first()
-    if activity:
-        session.delete(activity)
-    session.close()
+    """
+    Deletes Activity with one statement, its executions are deleted by ON DELETE CASCADE.
+    Returns dict with numbers of deleted activities and performed activities
+    """
+    a = Activity.__table__
+    pa = Performed_Activity.__table__
+    leaderboard_id = session.execute(select([a.c.leaderboard_id]).where(a.c.id == activity_id)).scalar()
+    if leaderboard_id is None:
+        return {'activities': 0, 'performed_activities': 0}
+    executions = session.execute(select([func.count()]).where(pa.c.activity_id == activity_id)).scalar()
+    _shift_activity_scores(session, activity_id=activity_id, new_points=0)
+    deleted = session.execute(a.delete().where(a.c.id == activity_id)).rowcount
+    _invalidate_activities(session, leaderboard_id)
+    return {'activities': deleted, 'performed_activities': executions if deleted else 0}
 
 @establish_session
 def get_leaderboard_by_activity_id(session, activity_id:int):
@@ -161,13 +529,76 @@ def get_leaderboard_by_activity_id(session, activity_id:int):
 
 
 @establish_session
-def get_leaderboard_activities(session, leaderboard_id:int):
-    result = session.query(Activity).filter_by(leaderboard_id=leaderboard_id)
-    return result
+def update_activity_points(session, leaderboard_id:int, activity_id:int, points:int):
+    """
+    Change points of the Activity and scores of participants who performed it
+    """
+    _shift_activity_scores(session, activity_id=activity_id, new_points=points)
+    session.execute(Activity.__table__.update().where(Activity.id == activity_id).values(points=points))
+    _invalidate_activities(session, leaderboard_id)
+
+
+def _invalidate_activities(session, leaderboard_id:int):
+    after_commit(session, lambda: activity_cache.invalidate(leaderboard_id))
+    after_commit(session, lambda: activity_versions.bump(leaderboard_id))
+    # Recent activities hold names and are gone with deleted activities
+    after_commit(session, lambda: recent_activities.invalidate_where(lambda key: key[1] == leaderboard_id))
+    # Point changes and deletes shift scores of many participants
+    after_commit(session, lambda: rank_indexes.invalidate(leaderboard_id))
+    # Activity names and points are part of the rendered score and log
+    _bump_version(session, leaderboard_id)
+
+def _bump_version(session, leaderboard_id:int):
+    after_commit(session, lambda: leaderboard_versions.bump(leaderboard_id))
+
+def get_leaderboard_version(leaderboard_id:int):
+    return leaderboard_versions.get(leaderboard_id)
+
+def get_leaderboard_activities(leaderboard_id:int):
+    """
+    Returns tuple of ActivityRow. Served from activity_cache
+    """
+    return activity_cache.get_or_load(leaderboard_id, lambda: _load_leaderboard_activities(leaderboard_id=leaderboard_id))
 
-class Leaderboard(Base):
+@establish_session
+def _load_leaderboard_activities(session, leaderboard_id:int):
+    rows = session.query(Activity.id, Activity.activity_name, Activity.points) \
+        .filter_by(leaderboard_id=leaderboard_id).order_by(Activity.id).all()
+    return tuple(ActivityRow(*row) for row in rows)
+
+def get_activities_page(leaderboard_id:int, after_id:int=None, before_id:int=None, limit:int=ACTIVITY_PAGE_SIZE):
+    """
+    Returns ActivityPage with up to `limit` activities ordered by id:
+    the first page, the page after `after_id` or the page before `before_id`.
+    Served from activity_cache
+    """
+    key = ('page', leaderboard_id, activity_versions.get(leaderboard_id), after_id, before_id, limit)
+    return activity_cache.get_or_load(key, lambda: _load_activities_page(leaderboard_id=leaderboard_id, after_id=after_id,
+                                                                         before_id=before_id, limit=limit))
+
+@establish_session
+def _load_activities_page(session, leaderboard_id:int, after_id:int, before_id:int, limit:int):
+    # Keyset pagination. ix_activities_leaderboard_id holds the primary key,
+    # so both directions are a range scan of limit + 1 index entries
+    query = session.query(Activity.id, Activity.activity_name, Activity.points).filter_by(leaderboard_id=leaderboard_id)
+    if before_id is not None:
+        rows = query.filter(Activity.id < before_id).order_by(Activity.id.desc()).limit(limit + 1).all()
+        if len(rows) >= limit:
+            has_prev = len(rows) > limit
+            has_next = session.query(query.filter(Activity.id >= before_id).exists()).scalar()
+            return ActivityPage(tuple(ActivityRow(*row) for row in reversed(rows[:limit])), has_prev, has_next)
+        # Activities before the page were deleted, show the first page instead
+        after_id = None
+    if after_id is not None:
+        query = query.filter(Activity.id > after_id)
+    rows = query.order_by(Activity.id).limit(limit + 1).all()
+    has_prev, has_next = after_id is not None, len(rows) > limit
+    return ActivityPage(tuple(ActivityRow(*row) for row in rows[:limit]), has_prev, has_next)
+
+class Leaderboard(Upsertable, Base):
 
     __tablename__ = 'leaderboards'
+    upsert_columns = ('name', )
 
     def __init__(self, id, name):
         self.id = id
@@ -178,6 +609,8 @@ class Leaderboard(Base):
     # Name of the Leaderboard. Equal to the name of the Chat conversation 
     name = Column(String(255))
     time_created = Column(DateTime(timezone=True), nullable=False, default=func.now())
+    # pytz name, UTC if not set. Day boundaries of week/month scores
+    timezone = Column(String(64))
 
     #Relationships
     participants = relationship("Participant")
@@ -185,9 +618,7 @@ class Leaderboard(Base):
 
     @establish_session
     def save_leaderboard(self, session):
-        session.merge(self)
-        session.commit()
-        session.close()
+        return self.upsert(session)
 
 
 @establish_session
@@ -196,51 +627,101 @@ def get_leaderboard_by_id(session, leaderboard_id:int):
     return leaderboard
 
 
+def leaderboard_has_activities(leaderboard_id:int):
+    return len(get_leaderboard_activities(leaderboard_id=leaderboard_id)) > 0
+
 @establish_session
-def leaderboard_has_activities(session, leaderboard_id:int):
-    exists = False
-    q = session.query(Activity).filter_by(leaderboard_id=leaderboard_id).count()
-    if q:
-        exists = True
-    return exists
-
-@establish_session
-def get_leaderboard_score(session, leaderboard_id:int):
-    qeury = f'''
-    SELECT users.name, COALESCE(SUM(a.points), 0) as 'points'
-    FROM `leaderboard`.`leaderboards` lb
-    JOIN `leaderboard`.`participants` p 
-        ON lb.id = p.leaderboard_id
-    JOIN `leaderboard`.`users` users
-        ON p.user_id = users.id
-    LEFT JOIN `leaderboard`.`performed_activity` pa
-        ON p.id = pa.participant_id
-    LEFT JOIN `leaderboard`.`activities` a
-        ON pa.activity_id = a.id 
-    WHERE lb.id = {leaderboard_id}
-    GROUP BY p.id
-    ORDER BY COALESCE(SUM(a.points), 0) DESC
-    '''
-    result = session.execute(qeury)
+def get_leaderboard_score(session, leaderboard_id:int, since=None):
+    """
+    All time score, or score of executions since the date (in the chat timezone)
+    summed from daily_executions
+    """
+    if since is not None:
+        return queries.run(session, 'leaderboard_score_since', leaderboard_id=leaderboard_id, since=since)
+    result = queries.run(session, 'leaderboard_score', leaderboard_id=leaderboard_id)
     return result
 
-class Participant(Base):
+@establish_session
+def get_execution_history(session, leaderboard_id:int):
+    """
+    Returns (activity_ids, user_ids, times) columns of all executions in the chat, oldest first
+    """
+    rows = queries.run(session, 'execution_history', leaderboard_id=leaderboard_id)
+    if not rows:
+        return (), (), ()
+    return tuple(zip(*rows))
+
+def iter_leaderboard_history(leaderboard_id:int, batch_size:int=1000):
+    """
+    Yields (time_created, user_id, name, activity_name, points) of all executions in the chat, oldest first.
+    Rows are read through a server-side cursor batch_size at a time, so memory does not grow with history
+    """
+    with session_scope() as session:
+        query = session.query(Performed_Activity.time_created, User.id, User.name, Activity.activity_name, Activity.points) \
+            .join(Participant, Participant.id == Performed_Activity.participant_id) \
+            .join(User, User.id == Participant.user_id) \
+            .join(Activity, Activity.id == Performed_Activity.activity_id) \
+            .filter(Performed_Activity.leaderboard_id == leaderboard_id) \
+            .order_by(Performed_Activity.time_created) \
+            .yield_per(batch_size)
+        for row in query:
+            yield row
+
+def get_leaderboard_timezone(leaderboard_id:int):
+    """
+    Returns pytz name of the chat timezone. Served from timezone_cache
+    """
+    return timezone_cache.get_or_load(leaderboard_id, lambda: _load_leaderboard_timezone(leaderboard_id=leaderboard_id))
+
+@establish_session
+def _load_leaderboard_timezone(session, leaderboard_id:int):
+    l = Leaderboard.__table__
+    return session.execute(select([l.c.timezone]).where(l.c.id == leaderboard_id)).scalar() or 'UTC'
+
+@establish_session
+def set_leaderboard_timezone(session, leaderboard_id:int, timezone:str):
+    """
+    Changes the chat timezone and rebuilds its daily_executions in it.
+    Raises pytz.UnknownTimeZoneError for unknown names
+    """
+    timezone = pytz.timezone(timezone).zone
+    l = Leaderboard.__table__
+    session.execute(l.update().where(l.c.id == leaderboard_id).values(timezone=timezone))
+    _rebuild_daily_executions(session, leaderboard_id=leaderboard_id, timezone=timezone)
+    after_commit(session, lambda: timezone_cache.invalidate(leaderboard_id))
+    _bump_version(session, leaderboard_id)
+    return timezone
+
+def score_window_start(leaderboard_id:int, window:str):
+    """
+    First day of the current 'week' (from Monday) or 'month' in the chat timezone. None for 'all'
+    """
+    if window == 'all':
+        return None
+    today = _local_day(None, get_leaderboard_timezone(leaderboard_id))
+    if window == 'week':
+        return today - timedelta(days=today.weekday())
+    if window == 'month':
+        return today.replace(day=1)
+    raise ValueError(f'Unknown score window {window}')
+
+class Participant(Upsertable, Base):
 
     __tablename__ = 'participants'
+    __table_args__ = (UniqueConstraint('leaderboard_id', 'user_id'), )
 
-    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    id = Column(BigIntegerId, primary_key=True, autoincrement=True)
     leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'))
     user_id = Column(BigInteger, ForeignKey('users.id'))
     time_created = Column(DateTime(timezone=True), nullable=False, default=func.now())
 
-    performed_activities = relationship("Performed_Activity", cascade="all, delete-orphan")
+    # Rows are deleted by ON DELETE CASCADE, not loaded to the session
+    performed_activities = relationship("Performed_Activity", cascade="all, delete-orphan", passive_deletes=True)
 
 
     @establish_session
     def save_participant(self, session):
-        session.merge(self)
-        session.commit()
-        session.close()
+        return self.upsert(session)
 
 @establish_session
 def get_participant_by_user_id_and_leaderboard_id(session, user_id:int, leaderboard_id:int):
@@ -249,13 +730,14 @@ def get_participant_by_user_id_and_leaderboard_id(session, user_id:int, leaderbo
 
 @establish_session
 def get_participants_by_leaderboard_id(session, leaderboard_id:int):
-    participants = session.query(Participant).filter_by(leaderboard_id=leaderboard_id)
+    participants = session.query(Participant).filter_by(leaderboard_id=leaderboard_id).all()
     return participants
 
 
-class User(Base):
+class User(Upsertable, Base):
 
     __tablename__ = 'users'
+    upsert_columns = ('name', )
     
     #Equal to User_ID in telegram 
     id = Column(BigInteger, primary_key=True)
@@ -274,9 +756,7 @@ class User(Base):
 
     @establish_session
     def save_user(self, session):
-        session.merge(self)
-        session.commit()
-        session.close()
+        return self.upsert(session)
 
 @establish_session
 def get_user_by_id(session, id:int):
@@ -284,42 +764,207 @@ def get_user_by_id(session, id:int):
     return user
 
 
-class Performed_Activity(Base):
+@establish_session
+def onboard(session, leaderboard_id:int, leaderboard_name:str, user_id:int, user_name:str):
+    """
+    Create/Update Leaderboard and User, add User to the Leaderboard.
+    Single transaction without reads before writes.
+    Returns (participant_added, leaderboard_has_activities)
+    """
+    _upsert(session, Leaderboard.__table__,
+            values={'id': leaderboard_id, 'name': leaderboard_name},
+            update={'name': leaderboard_name})
+    _upsert(session, User.__table__,
+            values={'id': user_id, 'name': user_name},
+            update={'name': user_name})
+
+    # IGNORE instead of ON DUPLICATE KEY UPDATE: with CLIENT_FOUND_ROWS (pymysql default)
+    # a no-op update reports the same rowcount as an insert
+    participant_added = _insert_ignore(session, Participant.__table__,
+                                       values={'leaderboard_id': leaderboard_id, 'user_id': user_id}) > 0
+
+    has_activities = session.execute(
+        select([exists().where(Activity.leaderboard_id == leaderboard_id)])
+    ).scalar()
+    # New participant or changed user name
+    _bump_version(session, leaderboard_id)
+    after_commit(session, lambda: rank_indexes.invalidate(leaderboard_id))
+    return participant_added, bool(has_activities)
 
-    __tablename__ = 'performed_activity'
 
-    id = Column(BigInteger, primary_key=True, autoincrement=True)
+class Performed_Activity(Upsertable, Base):
+
+    __tablename__ = 'performed_activity'
+    __table_args__ = (
+        # Latest activities of the participant (/cancel_activity)
+        Index('ix_performed_activity_participant_time', 'participant_id', 'time_created'),
+        # Latest activities of the leaderboard (/show_log)
+        Index('ix_performed_activity_leaderboard_time', 'leaderboard_id', 'time_created'),
+    )
+
+    id = Column(BigIntegerId, primary_key=True, autoincrement=True)
     time_created = Column(DateTime(timezone=True), nullable=False, default=func.now())
 
     #Relationships
-    activity_id = Column(BigInteger, ForeignKey('activities.id'))
-    participant_id = Column(BigInteger, ForeignKey('participants.id'))
+    activity_id = Column(BigInteger, ForeignKey('activities.id', ondelete='CASCADE'), index=True)
+    participant_id = Column(BigInteger, ForeignKey('participants.id', ondelete='CASCADE'))
+    # Denormalized from activities.leaderboard_id, so the log does not need a join to filter
+    leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'))
+    # Id of the write-behind journal entry, makes replay of the journal idempotent
+    tap_id = Column(String(32), unique=True)
 
     activities = relationship('Activity',
-                                backref=backref('performed_activities_act', cascade="all, delete-orphan")
+                                backref=backref('performed_activities_act', cascade="all, delete-orphan", passive_deletes=True)
                             )
     
     participants = relationship('Participant',
-                                backref=backref('performed_activities_partic', cascade="all, delete-orphan")
+                                backref=backref('performed_activities_partic', cascade="all, delete-orphan", passive_deletes=True)
                             )
      
 
-    def __init__(self, activity_id:int, participant_id:id):
+    def __init__(self, activity_id:int, participant_id:id, leaderboard_id:int):
         self.activity_id = activity_id
         self.participant_id = participant_id
+        self.leaderboard_id = leaderboard_id
 
     @establish_session
-    def save_performed_activity(self, session):
-        session.merge(self)
-        session.commit()
-        session.close()
+    def save_performed_activity(self, session, user_id:int=None, activity_name:str=None):
+        """
+        Saves execution with its points. user_id and activity_name known by the caller
+        save reading them back for the recent activities buffer
+        """
+        if self.time_created is None:
+            self.time_created = datetime.utcnow()
+        performed_activity_id = self.upsert(session)
+        _add_activity_points(session, participant_id=self.participant_id, activity_id=self.activity_id, sign=1,
+                             leaderboard_id=self.leaderboard_id)
+        _bump_version(session, self.leaderboard_id)
+        _remember_recent(session, performed_activity_id, user_id=user_id, leaderboard_id=self.leaderboard_id,
+                         name=activity_name, time_created=self.time_created)
+        _add_daily_execution(session, self.participant_id, self.activity_id, self.leaderboard_id, self.time_created, sign=1)
+        return performed_activity_id
 
-    @establish_session
-    def delete_performed_activity(self, session):
-        performed_activity = session.merge(self)
-        session.delete(performed_activity)
-        session.commit()
-        session.close()
+
+@establish_session
+def delete_performed_activity_by_id(session, id:int):
+    """
+    Deletes performed Activity and its points. Returns False if it was already deleted
+    """
+    row = session.query(Performed_Activity, Participant.user_id) \
+        .join(Participant, Participant.id == Performed_Activity.participant_id) \
+        .filter(Performed_Activity.id == id).first()
+    if row is None:
+        return False
+    performed_activity, user_id = row
+    _add_activity_points(session, participant_id=performed_activity.participant_id,
+                         activity_id=performed_activity.activity_id, sign=-1,
+                         leaderboard_id=performed_activity.leaderboard_id)
+    _bump_version(session, performed_activity.leaderboard_id)
+    _forget_recent(session, user_id, performed_activity.leaderboard_id, id)
+    _add_daily_execution(session, performed_activity.participant_id, performed_activity.activity_id,
+                         performed_activity.leaderboard_id, performed_activity.time_created, sign=-1)
+    session.delete(performed_activity)
+    return True
+
+@own_transaction
+def save_taps(session, taps:list):
+    """
+    Saves executions buffered by the write-behind journal in one transaction, committed before
+    it returns, so the journal can drop them. Tap is a dict with tap_id, user_id, user_name,
+    leaderboard_id, activity_id and time_created. Users who never sent /start are added.
+    Taps saved before (same tap_id) and taps of deleted Activities are skipped.
+    Returns number of saved taps
+    """
+    pa = Performed_Activity.__table__
+    a = Activity.__table__
+    p = Participant.__table__
+    u = User.__table__
+    saved = {row.tap_id for row in session.execute(
+        select([pa.c.tap_id]).where(pa.c.tap_id.in_([tap['tap_id'] for tap in taps])))}
+    activities = {row.id: row for row in session.execute(
+        select([a.c.id, a.c.activity_name, a.c.points]).where(a.c.id.in_({tap['activity_id'] for tap in taps})))}
+    taps = [tap for tap in taps if tap['tap_id'] not in saved and tap['activity_id'] in activities]
+    if not taps:
+        return 0
+
+    # Users and participants, one multi-row insert for new ones
+    _insert_ignore(session, u, list({tap['user_id']: {'id': tap['user_id'], 'name': tap.get('user_name')}
+                                     for tap in taps}.values()))
+    pairs = {(tap['user_id'], tap['leaderboard_id']) for tap in taps}
+    _insert_ignore(session, p, [{'user_id': user_id, 'leaderboard_id': leaderboard_id} for user_id, leaderboard_id in pairs])
+    participants = {(row.user_id, row.leaderboard_id): row.id for row in session.execute(
+        select([p.c.id, p.c.user_id, p.c.leaderboard_id])
+        .where(and_(p.c.user_id.in_({user_id for user_id, _ in pairs}),
+                    p.c.leaderboard_id.in_({leaderboard_id for _, leaderboard_id in pairs}))))}
+
+    session.execute(pa.insert().values([
+        {'tap_id': tap['tap_id'], 'activity_id': tap['activity_id'], 'leaderboard_id': tap['leaderboard_id'],
+         'participant_id': participants[(tap['user_id'], tap['leaderboard_id'])], 'time_created': tap['time_created']}
+        for tap in taps
+    ]))
+
+    # One score update per participant
+    points, leaderboards = {}, {}
+    for tap in taps:
+        participant_id = participants[(tap['user_id'], tap['leaderboard_id'])]
+        points[participant_id] = points.get(participant_id, 0) + activities[tap['activity_id']].points
+        leaderboards[participant_id] = tap['leaderboard_id']
+    ps = Participant_Score.__table__
+    for participant_id, delta in points.items():
+        updated = session.execute(
+            ps.update().where(ps.c.participant_id == participant_id).values(points=ps.c.points + delta)
+        ).rowcount
+        if not updated:
+            _rebuild_scores(session, participant_id=participant_id)
+        _track_score(session, participant_id, leaderboard_id=leaderboards[participant_id])
+
+    days = Counter()
+    for tap in taps:
+        participant_id = participants[(tap['user_id'], tap['leaderboard_id'])]
+        day = _local_day(tap['time_created'], get_leaderboard_timezone(tap['leaderboard_id']))
+        days[(participant_id, day, tap['activity_id'], tap['leaderboard_id'])] += 1
+    for (participant_id, day, activity_id, leaderboard_id), executions in days.items():
+        _upsert_daily_executions(session, participant_id, day, activity_id, leaderboard_id, executions)
+
+    ids = {row.tap_id: row.id for row in session.execute(
+        select([pa.c.id, pa.c.tap_id]).where(pa.c.tap_id.in_([tap['tap_id'] for tap in taps])))}
+    for tap in sorted(taps, key=lambda tap: tap['time_created']):
+        item = RecentActivity(ids[tap['tap_id']], activities[tap['activity_id']].activity_name, tap['time_created'])
+        key = (tap['user_id'], tap['leaderboard_id'])
+        after_commit(session, lambda key=key, item=item: recent_activities.push(key, item))
+    return len(taps)
+
+def _remember_recent(session, performed_activity_id:int, user_id:int, leaderboard_id:int, name:str, time_created):
+    if user_id is None or name is None:
+        user_id, name = session.query(Participant.user_id, Activity.activity_name) \
+            .select_from(Performed_Activity) \
+            .join(Participant, Participant.id == Performed_Activity.participant_id) \
+            .join(Activity, Activity.id == Performed_Activity.activity_id) \
+            .filter(Performed_Activity.id == performed_activity_id).one()
+    item = RecentActivity(performed_activity_id, name, time_created)
+    after_commit(session, lambda: recent_activities.push((user_id, leaderboard_id), item))
+
+def _forget_recent(session, user_id:int, leaderboard_id:int, performed_activity_id:int):
+    after_commit(session, lambda: recent_activities.remove((user_id, leaderboard_id),
+                                                           lambda item: item.id == performed_activity_id))
+
+def get_recent_activities(user_id:int, leaderboard_id:int):
+    """
+    Returns tuple of RecentActivity performed by user, newest first.
+    Served from recent_activities, loaded with get_performed_activities after a cold start
+    """
+    key = (user_id, leaderboard_id)
+    items = recent_activities.get(key)
+    if items is None:
+        generation = recent_activities.generation(key)
+        try:
+            rows = get_performed_activities(user_id=user_id, leaderboard_id=leaderboard_id, count=RECENT_ACTIVITIES_SIZE)
+        except:
+            recent_activities.fill(key, None, generation)
+            raise
+        items = tuple(RecentActivity(row['id'], row['name'], row['time']) for row in rows)
+        recent_activities.fill(key, items, generation)
+    return items
 
 
 @establish_session
@@ -327,23 +972,7 @@ def get_performed_activities(session, user_id:int, leaderboard_id:int, count:int
     """
     Returns Activities performed by user
     """
-    query = f'''
-        SELECT pa.id, pa.time_created as 'time', a.activity_name as 'name'
-        FROM `leaderboard`.`performed_activity` pa
-        JOIN `leaderboard`.`activities` a
-            ON a.id = pa.activity_id
-        JOIN `leaderboard`.`participants` p
-            ON p.id = pa.participant_id
-        JOIN `leaderboard`.`users` u 
-            ON u.id = p.user_id    
-        JOIN `leaderboard`.`leaderboards` ld
-            ON ld.id = a.leaderboard_id
-        WHERE u.id = {user_id}
-        AND ld.id = {leaderboard_id}
-        ORDER BY pa.time_created DESC
-        LIMIT {count};
-    '''
-    result = session.execute(query)
+    result = queries.run(session, 'performed_activities', user_id=user_id, leaderboard_id=leaderboard_id, count=count)
     return result
 
 @establish_session
@@ -360,20 +989,527 @@ def get_leaderboard_log(session, leaderboard_id:int, count:int):
     """
     Returns Activities Execution records from leaderboard
     """
-    query = f'''SELECT u.name, a.activity_name, a.points, pa.time_created
-            FROM `leaderboard`.`performed_activity` pa
-            JOIN `leaderboard`.`activities` a
-                ON a.id = pa.activity_id
-            JOIN `leaderboard`.`participants` p
-                ON p.id = pa.participant_id
-            JOIN `leaderboard`.`users` u
-                ON u.id = p.user_id
-            WHERE a.leaderboard_id = {leaderboard_id}
-            ORDER BY pa.time_created DESC
-            LIMIT {count};'''
-        
-    result = session.execute(query)
+    result = queries.run(session, 'leaderboard_log', leaderboard_id=leaderboard_id, count=count)
     return result
 
-# TODO: Check how to create base class with save_entity_name(self) method in order not 
-# to repeat same code in each class
\ No newline at end of file
+
+@establish_session
+def explain_log_queries(session, leaderboard_id:int, user_id:int):
+    """
+    Runs EXPLAIN for log queries.
+    Returns list of problems: full scans or filesorts over performed_activity
+    """
+    params = {
+        'leaderboard_log': {'leaderboard_id': leaderboard_id, 'count': 10},
+        'performed_activities': {'user_id': user_id, 'leaderboard_id': leaderboard_id, 'count': 10},
+    }
+    sqlite = session.get_bind().dialect.name == 'sqlite'
+    problems = []
+    for name, values in params.items():
+        for row in queries.explain(session, name, **values):
+            row = dict(row)
+            if sqlite:
+                detail = row['detail']
+                if detail.startswith('SCAN pa') or detail.startswith('SCAN TABLE performed_activity'):
+                    problems.append(f'{name}: full scan of performed_activity')
+                if 'TEMP B-TREE FOR ORDER BY' in detail:
+                    problems.append(f'{name}: filesort of performed_activity')
+                continue
+            if row.get('table') != 'pa':
+                continue
+            if row.get('type') == 'ALL':
+                problems.append(f'{name}: full scan of performed_activity')
+            if 'filesort' in (row.get('Extra') or ''):
+                problems.append(f'{name}: filesort of performed_activity')
+    return problems
+
+
+class Participant_Score(Base):
+    """
+    Materialized score of the participant.
+    Maintained in the same transaction as writes to performed_activity
+    """
+
+    __tablename__ = 'participant_scores'
+
+    participant_id = Column(BigInteger, ForeignKey('participants.id', ondelete='CASCADE'), primary_key=True)
+    leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'), index=True)
+    points = Column(BigInteger, nullable=False, default=0)
+
+
+def _add_activity_points(session, participant_id:int, activity_id:int, sign:int, leaderboard_id:int=None):
+    """
+    Add (sign=1) or subtract (sign=-1) points of the Activity to the participant score
+    """
+    ps = Participant_Score.__table__
+    a = Activity.__table__
+    points = select([a.c.points]).where(a.c.id == activity_id).as_scalar()
+    updated = session.execute(
+        ps.update().where(ps.c.participant_id == participant_id).values(points=ps.c.points + sign * points)
+    ).rowcount
+    if not updated:
+        # Participant has no score row yet: compute it from history, which already includes this change
+        _rebuild_scores(session, participant_id=participant_id)
+    _track_score(session, participant_id, leaderboard_id=leaderboard_id)
+
+def _track_score(session, participant_id:int, leaderboard_id:int=None):
+    """
+    Move the participant in its RankIndex to the points written by this transaction.
+    Points are read only if the RankIndex of leaderboard_id is loaded
+    """
+    if leaderboard_id is not None and rank_indexes.get(leaderboard_id) is None:
+        # Drops a load in flight, the next one reads committed points
+        after_commit(session, lambda: rank_indexes.invalidate(leaderboard_id))
+        return
+    ps = Participant_Score.__table__
+    row = session.execute(select([ps.c.leaderboard_id, ps.c.points]).where(ps.c.participant_id == participant_id)).first()
+    if row is None:
+        return
+    leaderboard_id, points = row
+
+    def move():
+        index = rank_indexes.get(leaderboard_id)
+        if index is None or not index.set_points(participant_id, points):
+            # Not loaded or new participant. Also drops a load in flight
+            rank_indexes.invalidate(leaderboard_id)
+    after_commit(session, move)
+
+def get_rank_index(leaderboard_id:int):
+    """
+    Returns RankIndex of the leaderboard. Served from rank_indexes
+    """
+    return rank_indexes.get_or_load(leaderboard_id, lambda: RankIndex(
+        (row['participant_id'], row['user_id'], row['name'], row['points'])
+        for row in get_leaderboard_score(leaderboard_id=leaderboard_id)
+    ))
+
+def _shift_activity_scores(session, activity_id:int, new_points:int):
+    """
+    Shift scores of participants who performed the Activity
+    by (new_points - current points) for every execution
+    """
+    ps = Participant_Score.__table__
+    pa = Performed_Activity.__table__
+    a = Activity.__table__
+    old_points = select([a.c.points]).where(a.c.id == activity_id).as_scalar()
+    executions = select([func.count()]).where(and_(pa.c.activity_id == activity_id,
+                                                   pa.c.participant_id == ps.c.participant_id)).as_scalar()
+    performers = select([pa.c.participant_id]).where(pa.c.activity_id == activity_id)
+    session.execute(
+        ps.update().where(ps.c.participant_id.in_(performers))
+                   .values(points=ps.c.points + (new_points - old_points) * executions)
+    )
+
+def _computed_scores(leaderboard_id:int=None, participant_id:int=None):
+    """
+    Scores computed from the whole performed_activity history
+    """
+    p = Participant.__table__
+    pa = Performed_Activity.__table__
+    a = Activity.__table__
+    query = select([p.c.id.label('participant_id'), p.c.leaderboard_id,
+                    func.coalesce(func.sum(a.c.points), 0).label('points')]) \
+        .select_from(p.outerjoin(pa, pa.c.participant_id == p.c.id).outerjoin(a, a.c.id == pa.c.activity_id)) \
+        .group_by(p.c.id, p.c.leaderboard_id)
+    if leaderboard_id is not None:
+        query = query.where(p.c.leaderboard_id == leaderboard_id)
+    if participant_id is not None:
+        query = query.where(p.c.id == participant_id)
+    return query
+
+def _rebuild_scores(session, leaderboard_id:int=None, participant_id:int=None):
+    ps = Participant_Score.__table__
+    delete = ps.delete()
+    if leaderboard_id is not None:
+        delete = delete.where(ps.c.leaderboard_id == leaderboard_id)
+    if participant_id is not None:
+        delete = delete.where(ps.c.participant_id == participant_id)
+    session.execute(delete)
+    computed = _computed_scores(leaderboard_id=leaderboard_id, participant_id=participant_id)
+    return session.execute(
+        ps.insert().from_select(['participant_id', 'leaderboard_id', 'points'], computed)
+    ).rowcount
+
+@establish_session
+def rebuild_participant_scores(session, leaderboard_id:int=None):
+    """
+    Recompute participant_scores and daily_executions from history.
+    Returns number of participant_scores rows written
+    """
+    _rebuild_daily_executions(session, leaderboard_id=leaderboard_id)
+    after_commit(session, rank_indexes.clear if leaderboard_id is None else lambda: rank_indexes.invalidate(leaderboard_id))
+    return _rebuild_scores(session, leaderboard_id=leaderboard_id)
+
+@establish_session
+def verify_participant_scores(session, leaderboard_id:int=None):
+    """
+    Returns list of (participant_id, stored points, actual points) that do not match history
+    """
+    ps = Participant_Score.__table__
+    computed = _computed_scores(leaderboard_id=leaderboard_id).alias('computed')
+    stored = func.coalesce(ps.c.points, 0)
+    query = select([computed.c.participant_id, ps.c.points, computed.c.points]) \
+        .select_from(computed.outerjoin(ps, ps.c.participant_id == computed.c.participant_id)) \
+        .where(stored != computed.c.points)
+    return session.execute(query).fetchall()
+
+
+class Daily_Execution(Base):
+    """
+    Number of executions per participant, day in the chat timezone and Activity.
+    Week/month scores sum at most 31 days of these with current Activity points.
+    Maintained in the same transaction as writes to performed_activity
+    """
+
+    __tablename__ = 'daily_executions'
+
+    participant_id = Column(BigInteger, ForeignKey('participants.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    activity_id = Column(BigInteger, ForeignKey('activities.id', ondelete='CASCADE'), primary_key=True, index=True)
+    leaderboard_id = Column(BigInteger, ForeignKey('leaderboards.id'), index=True)
+    executions = Column(Integer, nullable=False, default=0)
+
+
+def _local_day(time_created, timezone:str):
+    """
+    Day of the UTC time (now if None) in the timezone
+    """
+    if time_created is None:
+        time_created = datetime.utcnow()
+    if time_created.tzinfo is None:
+        time_created = pytz.utc.localize(time_created)
+    return time_created.astimezone(pytz.timezone(timezone)).date()
+
+def _upsert_daily_executions(session, participant_id:int, day, activity_id:int, leaderboard_id:int, executions:int):
+    de = Daily_Execution.__table__
+    _upsert(session, de,
+            {'participant_id': participant_id, 'day': day, 'activity_id': activity_id,
+             'leaderboard_id': leaderboard_id, 'executions': executions},
+            {'executions': de.c.executions + executions})
+
+def _add_daily_execution(session, participant_id:int, activity_id:int, leaderboard_id:int, time_created, sign:int):
+    """
+    Count (sign=1) or uncount (sign=-1) execution in its day
+    """
+    day = _local_day(time_created, get_leaderboard_timezone(leaderboard_id))
+    if sign > 0:
+        _upsert_daily_executions(session, participant_id, day, activity_id, leaderboard_id, 1)
+        return
+    de = Daily_Execution.__table__
+    session.execute(de.update().where(and_(de.c.participant_id == participant_id, de.c.day == day,
+                                           de.c.activity_id == activity_id))
+                                 .values(executions=de.c.executions - 1))
+
+def _rebuild_daily_executions(session, leaderboard_id:int=None, timezone:str=None):
+    """
+    Recompute daily_executions from history. Days are computed here,
+    timezone conversion in SQL needs MySQL timezone tables
+    """
+    de = Daily_Execution.__table__
+    pa = Performed_Activity.__table__
+    l = Leaderboard.__table__
+    delete = de.delete()
+    history = select([pa.c.participant_id, pa.c.activity_id, pa.c.leaderboard_id, pa.c.time_created, l.c.timezone]) \
+        .select_from(pa.join(l, l.c.id == pa.c.leaderboard_id))
+    if leaderboard_id is not None:
+        delete = delete.where(de.c.leaderboard_id == leaderboard_id)
+        history = history.where(pa.c.leaderboard_id == leaderboard_id)
+    session.execute(delete)
+
+    days = Counter()
+    for row in session.execute(history):
+        day = _local_day(row.time_created, timezone or row.timezone or 'UTC')
+        days[(row.participant_id, day, row.activity_id, row.leaderboard_id)] += 1
+    rows = [{'participant_id': participant_id, 'day': day, 'activity_id': activity_id,
+             'leaderboard_id': board_id, 'executions': executions}
+            for (participant_id, day, activity_id, board_id), executions in days.items()]
+    for start in range(0, len(rows), 1000):
+        session.execute(de.insert(), rows[start:start + 1000])
+    return len(rows)
+
+
+class Global_Snapshot(Base):
+    """
+    One refresh of global_leaderboard_scores and global_user_scores.
+    Rows of a snapshot are written in chunks, readers use the newest completed snapshot
+    """
+
+    __tablename__ = 'global_snapshots'
+
+    id = Column(BigIntegerId, primary_key=True, autoincrement=True)
+    time_created = Column(DateTime, nullable=False)
+    # NULL while the refresh is running
+    time_completed = Column(DateTime)
+
+
+class Global_Leaderboard_Score(Base):
+    """
+    Total points of the chat in a snapshot
+    """
+
+    __tablename__ = 'global_leaderboard_scores'
+    __table_args__ = (Index('ix_global_leaderboard_scores_snapshot_points', 'snapshot_id', 'points'), )
+
+    snapshot_id = Column(BigInteger, ForeignKey('global_snapshots.id', ondelete='CASCADE'), primary_key=True)
+    leaderboard_id = Column(BigInteger, primary_key=True)
+    name = Column(String(255))
+    points = Column(BigInteger, nullable=False)
+    participants = Column(Integer, nullable=False)
+
+
+class Global_User_Score(Base):
+    """
+    Points of the user summed over all chats in a snapshot
+    """
+
+    __tablename__ = 'global_user_scores'
+    __table_args__ = (Index('ix_global_user_scores_snapshot_points', 'snapshot_id', 'points'), )
+
+    snapshot_id = Column(BigInteger, ForeignKey('global_snapshots.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    name = Column(String(255))
+    points = Column(BigInteger, nullable=False)
+    leaderboards = Column(Integer, nullable=False)
+
+
+def refresh_global_scores(chunk_size:int=GLOBAL_CHUNK_SIZE):
+    """
+    Write a new global snapshot from participant_scores. Chats and users are aggregated
+    by INSERT ... SELECT over key ranges of chunk_size, one transaction per chunk,
+    so neither the bot nor the database holds more than a chunk at a time.
+    Deletes older snapshots. Returns GlobalSnapshot with number of rows written
+    """
+    gs = Global_Snapshot.__table__
+    with session_scope() as session:
+        snapshot_id = session.execute(gs.insert().values(time_created=datetime.utcnow())).inserted_primary_key[0]
+
+    leaderboards = _refresh_global_chunks(snapshot_id, Leaderboard.__table__.c.id, _global_leaderboard_scores, chunk_size)
+    users = _refresh_global_chunks(snapshot_id, User.__table__.c.id, _global_user_scores, chunk_size)
+
+    time_completed = datetime.utcnow()
+    with session_scope() as session:
+        session.execute(gs.update().where(gs.c.id == snapshot_id).values(time_completed=time_completed))
+        # Refreshes of other instances still running are kept for an hour
+        stale = [row.id for row in session.execute(select([gs.c.id]).where(and_(
+            gs.c.id < snapshot_id,
+            or_(gs.c.time_completed != None, gs.c.time_created < time_completed - timedelta(hours=1)))))]
+        if stale:
+            # Rows are deleted by ON DELETE CASCADE
+            session.execute(gs.delete().where(gs.c.id.in_(stale)))
+        after_commit(session, global_cache.clear)
+    return GlobalSnapshot(snapshot_id, time_completed, leaderboards, users)
+
+def _refresh_global_chunks(snapshot_id:int, key, aggregate, chunk_size:int):
+    """
+    Run aggregate(snapshot_id, first, last) over consecutive ranges of chunk_size keys.
+    Returns number of rows written
+    """
+    written, after = 0, None
+    while True:
+        with session_scope() as session:
+            query = select([key]).order_by(key).limit(chunk_size)
+            if after is not None:
+                query = query.where(key > after)
+            keys = [row[0] for row in session.execute(query)]
+            if not keys:
+                return written
+            written += session.execute(aggregate(snapshot_id, keys[0], keys[-1])).rowcount
+        after = keys[-1]
+
+def _global_leaderboard_scores(snapshot_id:int, first:int, last:int):
+    l = Leaderboard.__table__
+    p = Participant.__table__
+    ps = Participant_Score.__table__
+    # Participants without score rows have not performed anything yet
+    totals = select([literal(snapshot_id, BigInteger), l.c.id, l.c.name,
+                     func.coalesce(func.sum(ps.c.points), 0), func.count(p.c.id)]) \
+        .select_from(l.join(p, p.c.leaderboard_id == l.c.id).outerjoin(ps, ps.c.participant_id == p.c.id)) \
+        .where(l.c.id.between(first, last)) \
+        .group_by(l.c.id, l.c.name)
+    return Global_Leaderboard_Score.__table__.insert().from_select(
+        ['snapshot_id', 'leaderboard_id', 'name', 'points', 'participants'], totals)
+
+def _global_user_scores(snapshot_id:int, first:int, last:int):
+    u = User.__table__
+    p = Participant.__table__
+    ps = Participant_Score.__table__
+    totals = select([literal(snapshot_id, BigInteger), u.c.id, u.c.name,
+                     func.coalesce(func.sum(ps.c.points), 0), func.count(p.c.id)]) \
+        .select_from(u.join(p, p.c.user_id == u.c.id).outerjoin(ps, ps.c.participant_id == p.c.id)) \
+        .where(u.c.id.between(first, last)) \
+        .group_by(u.c.id, u.c.name)
+    return Global_User_Score.__table__.insert().from_select(
+        ['snapshot_id', 'user_id', 'name', 'points', 'leaderboards'], totals)
+
+def get_global_top(count:int):
+    """
+    Returns GlobalSnapshot with top chats and top users of the newest snapshot,
+    None if there is no completed snapshot. Served from global_cache
+    """
+    snapshot = global_cache.get(count)
+    if snapshot is None:
+        snapshot = _load_global_top(count=count)
+        if snapshot is not None:
+            global_cache.set(count, snapshot)
+    return snapshot
+
+@establish_session
+def _load_global_top(session, count:int):
+    snapshot = queries.run(session, 'global_snapshot')
+    if not snapshot:
+        return None
+    snapshot_id, time_completed = snapshot[0]
+    return GlobalSnapshot(snapshot_id, time_completed,
+                          queries.run(session, 'global_top_leaderboards', snapshot_id=snapshot_id, count=count),
+                          queries.run(session, 'global_top_users', snapshot_id=snapshot_id, count=count))
+
+@establish_session
+def get_global_leaderboard_rank(session, snapshot_id:int, leaderboard_id:int):
+    """
+    Returns (rank, chats) of the chat in the snapshot, None if chat is not in it
+    """
+    rows = queries.run(session, 'global_leaderboard_rank', snapshot_id=snapshot_id, leaderboard_id=leaderboard_id)
+    if not rows or rows[0]['rank'] is None:
+        return None
+    return rows[0]['rank'], rows[0]['chats']
+
+
+@establish_session
+def prepare_import(session, leaderboard_id:int, leaderboard_name:str, activities:dict, users:dict,
+                   author_user_id:int=None, author_name:str=None, chunk_size:int=1000):
+    """
+    Creates the leaderboard, missing Activities (name -> points), users (id -> name) and participants
+    of a bulk import with multi-row inserts. Existing Activities and user names are kept.
+    New Activities are authored by author_user_id, who is added to users if needed.
+    Returns id maps: Activity id by name and participant id by user id
+    """
+    l = Leaderboard.__table__
+    a = Activity.__table__
+    u = User.__table__
+    p = Participant.__table__
+    _insert_ignore(session, l, {'id': leaderboard_id, 'name': leaderboard_name})
+    user_rows = [{'id': user_id, 'name': name} for user_id, name in users.items()]
+    if author_user_id is not None and author_user_id not in users:
+        user_rows.append({'id': author_user_id, 'name': author_name})
+    for start in range(0, len(user_rows), chunk_size):
+        _insert_ignore(session, u, user_rows[start:start + chunk_size])
+
+    existing = {row.activity_name for row in session.execute(
+        select([a.c.activity_name]).where(a.c.leaderboard_id == leaderboard_id))}
+    new = [{'activity_name': name, 'points': points, 'author_user_id': author_user_id, 'leaderboard_id': leaderboard_id}
+           for name, points in activities.items() if name not in existing]
+    if new:
+        session.execute(a.insert(), new)
+        _invalidate_activities(session, leaderboard_id)
+    activity_ids = {row.activity_name: row.id for row in session.execute(
+        select([a.c.id, a.c.activity_name]).where(a.c.leaderboard_id == leaderboard_id).order_by(a.c.id))}
+
+    participant_rows = [{'user_id': user_id, 'leaderboard_id': leaderboard_id} for user_id in users]
+    for start in range(0, len(participant_rows), chunk_size):
+        _insert_ignore(session, p, participant_rows[start:start + chunk_size])
+    participant_ids = {row.user_id: row.id for row in session.execute(
+        select([p.c.id, p.c.user_id]).where(p.c.leaderboard_id == leaderboard_id))}
+    return activity_ids, participant_ids
+
+@establish_session
+def save_imported_executions(session, executions:list):
+    """
+    Inserts a chunk of imported executions (dicts with tap_id, activity_id, participant_id, leaderboard_id,
+    time_created and occurrence) with executemany. occurrence is the number of the same execution
+    (participant, Activity and time) earlier in the file. It is skipped if the chat already has more
+    such executions, whether imported or recorded by the bot, or if it was imported before (same tap_id).
+    Scores are rebuilt by finish_import(). Returns number of inserted rows
+    """
+    pa = Performed_Activity.__table__
+    saved = {row.tap_id for row in session.execute(
+        select([pa.c.tap_id]).where(pa.c.tap_id.in_([execution['tap_id'] for execution in executions])))}
+    leaderboard_ids = {execution['leaderboard_id'] for execution in executions}
+    times = {execution['time_created'] for execution in executions}
+    existing = {(row.participant_id, row.activity_id, row.time_created): row.executions for row in session.execute(
+        select([pa.c.participant_id, pa.c.activity_id, pa.c.time_created, func.count().label('executions')])
+        .where(and_(pa.c.leaderboard_id.in_(leaderboard_ids), pa.c.time_created.in_(times)))
+        .group_by(pa.c.participant_id, pa.c.activity_id, pa.c.time_created))}
+    rows = {}
+    for execution in executions:
+        key = (execution['participant_id'], execution['activity_id'], execution['time_created'])
+        if execution['tap_id'] in saved or execution['occurrence'] < existing.get(key, 0):
+            continue
+        rows[execution['tap_id']] = {column: value for column, value in execution.items() if column != 'occurrence'}
+    if rows:
+        session.execute(pa.insert(), list(rows.values()))
+    return len(rows)
+
+@establish_session
+def finish_import(session, leaderboard_id:int):
+    """
+    Rebuild scores and daily rows of the chat from history after a bulk import, drop its cached views
+    """
+    rebuild_participant_scores(leaderboard_id=leaderboard_id)
+    _invalidate_activities(session, leaderboard_id)
+
+
+class Bot_State(Base):
+    """
+    Persisted ConversationHandler states and user_data (see persistence.py)
+    and menu button payloads (see callbacks.py)
+    """
+
+    __tablename__ = 'bot_state'
+
+    # 'conversation', 'user_data' or 'callback'
+    kind = Column(String(16), primary_key=True)
+    # Name of the ConversationHandler, empty for user_data and callbacks
+    name = Column(String(64), primary_key=True)
+    # 'chat_id:user_id' for conversations, user_id for user_data, token for callbacks
+    state_key = Column(String(64), primary_key=True)
+    # Compact JSON. user_data holds raw message texts of up to 4096 characters
+    data = Column(Text, nullable=False)
+    time_updated = Column(DateTime, nullable=False, index=True)
+
+
+@establish_session
+def get_bot_states(session, kind:str, name:str, updated_after):
+    """
+    Returns (state_key, data, time_updated) of states updated after given time
+    """
+    table = Bot_State.__table__
+    query = select([table.c.state_key, table.c.data, table.c.time_updated]).where(and_(
+        table.c.kind == kind, table.c.name == name, table.c.time_updated > updated_after))
+    return session.execute(query).fetchall()
+
+@establish_session
+def save_bot_states(session, saved:list, deleted:list, expired_before):
+    """
+    Upsert saved states, delete deleted (kind, name, state_key) and states not updated since expired_before
+    """
+    table = Bot_State.__table__
+    _upsert_many(session, table, saved, update_columns=('data', 'time_updated'))
+    for kind, name, state_key in deleted:
+        session.execute(table.delete().where(and_(
+            table.c.kind == kind, table.c.name == name, table.c.state_key == state_key)))
+    session.execute(table.delete().where(table.c.time_updated < expired_before))
+
+@establish_session
+def save_callback_payloads(session, payloads:list, expired_before=None):
+    """
+    Insert (token, data) of menu buttons with one multi-row insert.
+    Deletes payloads created before expired_before if given
+    """
+    table = Bot_State.__table__
+    now = datetime.utcnow()
+    if payloads:
+        session.execute(table.insert(), [{'kind': 'callback', 'name': '', 'state_key': token, 'data': data,
+                                          'time_updated': now} for token, data in payloads])
+    if expired_before is not None:
+        session.execute(table.delete().where(and_(
+            table.c.kind == 'callback', table.c.time_updated < expired_before)))
+
+@establish_session
+def get_callback_payload(session, token:str, created_after):
+    """
+    Returns data of a menu button created after given time or None
+    """
+    table = Bot_State.__table__
+    return session.execute(select([table.c.data]).where(and_(
+        table.c.kind == 'callback', table.c.name == '', table.c.state_key == token,
+        table.c.time_updated > created_after))).scalar()
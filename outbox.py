@@ -0,0 +1,269 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram limit of message text
+MAX_TEXT_LENGTH = 4096
+
+
+class TokenBucket:
+    """
+    `rate` sends per second with bursts of up to `burst` sends
+    """
+
+    def __init__(self, rate:float, burst:float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now:float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now:float):
+        """
+        Seconds until one token is available
+        """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now:float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Item:
+
+    __slots__ = ('method', 'args', 'kwargs', 'future', 'enqueued', 'mergeable', 'retries')
+
+    def __init__(self, method, args, kwargs, mergeable):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.mergeable = mergeable
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.retries = 0
+
+
+class Outbox:
+    """
+    Outbound Telegram request queue.
+
+    - Enforces a global budget and a per-chat budget (groups have a lower one)
+    - Retries 429 (RetryAfter) after the delay given by Telegram, pausing that chat
+    - Merges consecutive plain text messages to the same chat sent within
+      `coalesce_window` seconds into one message of up to 4096 characters
+    - Keeps requests of one chat in order
+    """
+
+    def __init__(self, global_rate:float=30, chat_rate:float=1, chat_burst:float=3,
+                 group_rate:float=20 / 60, group_burst:float=5,
+                 coalesce_window:float=0.15, senders:int=8, max_retries:int=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.senders = senders
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        # chat_id -> deque of pending items, only chats with pending items
+        self._queues = {}
+        # chat_id -> time before which the chat must not be sent to (429)
+        self._paused = {}
+        # Chats with a request in flight
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='outbox')
+
+        self.stats = {'queued': 0, 'sent': 0, 'merged': 0, 'retries': 0, 'failed': 0,
+                      'latency_last': 0.0, 'latency_max': 0.0, 'latency_total': 0.0}
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout:float=10):
+        """
+        Stop after pending requests are sent or timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._queues or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        self._senders.shutdown()
+        logger.info(f'Outbox stopped. {self.get_stats()}')
+
+    def submit(self, chat_id, method, args=(), kwargs=None, mergeable=False):
+        """
+        Queue Telegram request. Returns concurrent.futures.Future with its result
+        """
+        item = _Item(method, args, kwargs or {}, mergeable)
+        with self._cond:
+            self._queues.setdefault(chat_id, deque()).append(item)
+            self.stats['queued'] += 1
+            self._cond.notify()
+        return item.future
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats, depth=sum(len(queue) for queue in self._queues.values()))
+        if stats['sent']:
+            stats['latency_avg'] = stats['latency_total'] / stats['sent']
+        return stats
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups
+            if chat_id is not None and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _wait_time(self, chat_id, now:float):
+        head = self._queues[chat_id][0]
+        wait = max(self._paused.get(chat_id, 0) - now, self._bucket(chat_id).wait_time(now))
+        if head.mergeable:
+            # Give following messages a chance to be merged
+            wait = max(wait, head.enqueued + self.coalesce_window - now)
+        return wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                ready, wait = None, None
+                for chat_id in self._queues:
+                    if chat_id in self._busy:
+                        continue
+                    chat_wait = self._wait_time(chat_id, now)
+                    if wait is None or chat_wait < wait:
+                        ready, wait = chat_id, chat_wait
+                if ready is None:
+                    self._cond.wait()
+                    continue
+                wait = max(wait, self._global.wait_time(now))
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                batch = self._take_batch(ready)
+                self._global.take(now)
+                self._bucket(ready).take(now)
+                self._paused.pop(ready, None)
+                self._busy.add(ready)
+                self._prune_buckets(now)
+            self._senders.submit(self._deliver, ready, batch)
+
+    def _take_batch(self, chat_id):
+        """
+        Pop the head request, merged with following plain text messages while the text fits one message
+        """
+        queue = self._queues[chat_id]
+        batch = [queue.popleft()]
+        if batch[0].mergeable:
+            options = {key: value for key, value in batch[0].kwargs.items() if key != 'text'}
+            length = len(batch[0].kwargs['text'])
+            while queue and queue[0].mergeable and \
+                    length + 1 + len(queue[0].kwargs['text']) <= MAX_TEXT_LENGTH and \
+                    {key: value for key, value in queue[0].kwargs.items() if key != 'text'} == options:
+                length += 1 + len(queue[0].kwargs['text'])
+                batch.append(queue.popleft())
+        if not queue:
+            del self._queues[chat_id]
+        return batch
+
+    def _prune_buckets(self, now:float):
+        if len(self._buckets) > 10000:
+            for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                            if chat_id not in self._queues and now - bucket.updated > 60]:
+                del self._buckets[chat_id]
+
+    def _deliver(self, chat_id, batch):
+        head = batch[0]
+        kwargs = head.kwargs
+        if len(batch) > 1:
+            kwargs = dict(kwargs, text='\n'.join(item.kwargs['text'] for item in batch))
+        try:
+            result = head.method(*head.args, **kwargs)
+        except RetryAfter as e:
+            with self._cond:
+                self.stats['retries'] += 1
+                if head.retries < self.max_retries:
+                    head.retries += 1
+                    self._paused[chat_id] = time.monotonic() + e.retry_after
+                    self._queues.setdefault(chat_id, deque()).extendleft(reversed(batch))
+                    self._busy.discard(chat_id)
+                    self._cond.notify()
+                    return
+            self._finish(chat_id, batch, error=e)
+        except Exception as e:
+            logger.warning(f'Sending to chat {chat_id} failed: {e}')
+            self._finish(chat_id, batch, error=e)
+        else:
+            self._finish(chat_id, batch, result=result)
+
+    def _finish(self, chat_id, batch, result=None, error=None):
+        now = time.monotonic()
+        with self._cond:
+            if error is None:
+                self.stats['sent'] += 1
+                self.stats['merged'] += len(batch) - 1
+                latency = now - batch[0].enqueued
+                self.stats['latency_last'] = latency
+                self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+                self.stats['latency_total'] += latency
+            else:
+                self.stats['failed'] += 1
+            self._busy.discard(chat_id)
+            self._cond.notify()
+        for item in batch:
+            if error is None:
+                item.future.set_result(result)
+            else:
+                item.future.set_exception(error)
+
+
+class QueuedBot(Bot):
+    """
+    Bot that sends messages and edits through Outbox
+    """
+
+    def __init__(self, token, outbox:Outbox, **kwargs):
+        super().__init__(token, **kwargs)
+        self._outbox = outbox
+
+    def send_message(self, chat_id, text, **kwargs):
+        kwargs = dict(kwargs, chat_id=chat_id, text=text)
+        return self._outbox.submit(chat_id, super().send_message, kwargs=kwargs,
+                                   mergeable=kwargs.get('reply_markup') is None)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._outbox.submit(kwargs.get('chat_id'), super().edit_message_text, args, kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self._outbox.submit(kwargs.get('chat_id'), super().edit_message_reply_markup, args, kwargs)
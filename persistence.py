@@ -0,0 +1,178 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+
+from telegram.ext import BasePersistence
+
+from model import get_bot_states, save_bot_states
+
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION = 'conversation'
+USER_DATA = 'user_data'
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+def _int_keys(data:dict):
+    """
+    JSON object keys are strings. State variables used as user_data keys are ints
+    """
+    return {int(key) if key.lstrip('-').isdigit() else key: value for key, value in data.items()}
+
+
+class SQLPersistence(BasePersistence):
+    """
+    Stores ConversationHandler states and user_data in the bot_state table
+    (SQLite file locally, MySQL in prod - whatever model engine points to).
+
+    Updates only mark keys dirty. Dirty keys are written in one transaction every
+    `flush_interval` seconds and on shutdown. Conversations and user_data not updated
+    for `ttl` seconds are evicted from memory and from the database.
+    """
+
+    def __init__(self, flush_interval:float=5, ttl:float=7 * 24 * 3600):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._conversations = {}
+        self._user_data = None
+        # (kind, name, key) -> last update time
+        self._touched = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start background flushing
+        """
+        self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush conversation states')
+
+    def _expired_before(self):
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            conversations = {}
+            for state_key, data, time_updated in get_bot_states(kind=CONVERSATION, name=name,
+                                                                updated_after=self._expired_before()):
+                chat_id, user_id = state_key.split(':')
+                key = (int(chat_id), int(user_id))
+                conversations[key] = json.loads(data)
+                self._loaded((CONVERSATION, name, key), time_updated)
+            self._conversations[name] = conversations
+        return self._conversations[name]
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            self._touch((CONVERSATION, name, key))
+
+    def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = defaultdict(dict)
+            for state_key, data, time_updated in get_bot_states(kind=USER_DATA, name='',
+                                                                updated_after=self._expired_before()):
+                self._user_data[int(state_key)] = _int_keys(json.loads(data))
+                self._loaded((USER_DATA, '', int(state_key)), time_updated)
+        return self._user_data
+
+    def update_user_data(self, user_id, data):
+        with self._lock:
+            self._touch((USER_DATA, '', user_id))
+
+    def _touch(self, key):
+        self._touched[key] = datetime.utcnow()
+        self._dirty.add(key)
+
+    def _loaded(self, key, time_updated):
+        """
+        States loaded from the database expire TTL after their last update
+        """
+        with self._lock:
+            self._touched.setdefault(key, time_updated)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        """
+        Write dirty states, evict stale ones
+        """
+        expired_before = self._expired_before()
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            stale = [key for key, touched in self._touched.items() if touched < expired_before]
+            for key in stale:
+                del self._touched[key]
+                self._evict(key)
+
+            saved, deleted = [], []
+            for key in dirty:
+                kind, name, state_key = key
+                value = self._value(key)
+                if key not in self._touched or value in (None, {}):
+                    # Ended conversation or empty user_data. Stays in memory until TTL,
+                    # a handler may still hold a reference to the dict
+                    deleted.append((kind, name, self._state_key(key)))
+                    continue
+                saved.append({'kind': kind, 'name': name, 'state_key': self._state_key(key),
+                              'data': _dumps(value), 'time_updated': self._touched[key]})
+
+        if saved or deleted or stale:
+            try:
+                save_bot_states(saved=saved, deleted=deleted, expired_before=expired_before)
+            except Exception:
+                # Written with the next flush, keys dirtied meanwhile are kept
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+            logger.debug(f'Flushed {len(saved)} state(s), deleted {len(deleted)}, evicted {len(stale)}')
+
+    def _value(self, key):
+        kind, name, state_key = key
+        if kind == CONVERSATION:
+            return self._conversations.get(name, {}).get(state_key)
+        return (self._user_data or {}).get(state_key)
+
+    def _evict(self, key):
+        kind, name, state_key = key
+        if kind == CONVERSATION:
+            self._conversations.get(name, {}).pop(state_key, None)
+        elif self._user_data is not None:
+            self._user_data.pop(state_key, None)
+
+    @staticmethod
+    def _state_key(key):
+        kind, name, state_key = key
+        if kind == CONVERSATION:
+            return ':'.join(str(part) for part in state_key)
+        return str(state_key)
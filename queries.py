@@ -0,0 +1,168 @@
+from sqlalchemy import text, DateTime
+import threading
+import time
+
+# Catalog of raw SQL statements used by model.py.
+# Statements are built once at import with bound parameters and without schema name,
+# so the statement text is the same for every call and the compiled form is cached.
+
+STATEMENTS = {
+    # Reads materialized participant_scores, O(participants)
+    'leaderboard_score': text('''
+        SELECT p.id AS participant_id, users.id AS user_id, users.name, COALESCE(ps.points, 0) AS points
+        FROM participants p
+        JOIN users
+            ON p.user_id = users.id
+        LEFT JOIN participant_scores ps
+            ON p.id = ps.participant_id
+        WHERE p.leaderboard_id = :leaderboard_id
+        ORDER BY COALESCE(ps.points, 0) DESC
+    '''),
+
+    # Week/month score. Range scan of daily_executions primary key per participant,
+    # at most 31 days x performed Activities, valued with current Activity points
+    'leaderboard_score_since': text('''
+        SELECT users.id AS user_id, users.name, COALESCE(SUM(de.executions * a.points), 0) AS points
+        FROM participants p
+        JOIN users
+            ON p.user_id = users.id
+        LEFT JOIN daily_executions de
+            ON de.participant_id = p.id
+            AND de.day >= :since
+        LEFT JOIN activities a
+            ON a.id = de.activity_id
+        WHERE p.leaderboard_id = :leaderboard_id
+        GROUP BY users.id, users.name
+        ORDER BY points DESC
+    '''),
+
+    # Range scan of ix_performed_activity_participant_time
+    'performed_activities': text('''
+        SELECT pa.id, pa.time_created AS time, a.activity_name AS name
+        FROM performed_activity pa
+        JOIN activities a
+            ON a.id = pa.activity_id
+        WHERE pa.participant_id = (
+            SELECT p.id
+            FROM participants p
+            WHERE p.user_id = :user_id
+            AND p.leaderboard_id = :leaderboard_id
+        )
+        ORDER BY pa.time_created DESC
+        LIMIT :count
+    ''').columns(time=DateTime),
+
+    # Range scan of ix_performed_activity_leaderboard_time
+    'leaderboard_log': text('''
+        SELECT u.name, a.activity_name, a.points, pa.time_created
+        FROM performed_activity pa
+        JOIN activities a
+            ON a.id = pa.activity_id
+        JOIN participants p
+            ON p.id = pa.participant_id
+        JOIN users u
+            ON u.id = p.user_id
+        WHERE pa.leaderboard_id = :leaderboard_id
+        ORDER BY pa.time_created DESC
+        LIMIT :count
+    ''').columns(time_created=DateTime),
+
+    # Execution history of the chat for analytics.py. Range scan of ix_performed_activity_leaderboard_time,
+    # participants by primary key
+    'execution_history': text('''
+        SELECT pa.activity_id, p.user_id, pa.time_created
+        FROM performed_activity pa
+        JOIN participants p
+            ON p.id = pa.participant_id
+        WHERE pa.leaderboard_id = :leaderboard_id
+        ORDER BY pa.time_created
+    ''').columns(time_created=DateTime),
+
+    # Newest completed global snapshot. Primary key range scan from the end
+    'global_snapshot': text('''
+        SELECT id, time_completed
+        FROM global_snapshots
+        WHERE time_completed IS NOT NULL
+        ORDER BY id DESC
+        LIMIT 1
+    ''').columns(time_completed=DateTime),
+
+    # Backward range scan of ix_global_leaderboard_scores_snapshot_points
+    'global_top_leaderboards': text('''
+        SELECT leaderboard_id, name, points, participants
+        FROM global_leaderboard_scores
+        WHERE snapshot_id = :snapshot_id
+        ORDER BY points DESC
+        LIMIT :count
+    '''),
+
+    # Backward range scan of ix_global_user_scores_snapshot_points
+    'global_top_users': text('''
+        SELECT user_id, name, points, leaderboards
+        FROM global_user_scores
+        WHERE snapshot_id = :snapshot_id
+        ORDER BY points DESC
+        LIMIT :count
+    '''),
+
+    # Rank of the chat: chats with more points, counted in ix_global_leaderboard_scores_snapshot_points
+    'global_leaderboard_rank': text('''
+        SELECT 1 + (
+            SELECT COUNT(*)
+            FROM global_leaderboard_scores g
+            WHERE g.snapshot_id = :snapshot_id
+            AND g.points > chat.points
+        ) AS `rank`, (
+            SELECT COUNT(*)
+            FROM global_leaderboard_scores g
+            WHERE g.snapshot_id = :snapshot_id
+        ) AS chats
+        FROM global_leaderboard_scores chat
+        WHERE chat.snapshot_id = :snapshot_id
+        AND chat.leaderboard_id = :leaderboard_id
+    '''),
+}
+
+# Compiled statements, shared by all connections
+_compiled_cache = {}
+
+# Per-statement timing counters
+query_stats = {name: {'calls': 0, 'total': 0.0, 'max': 0.0} for name in STATEMENTS}
+_stats_lock = threading.Lock()
+
+
+def run(session, name:str, **params):
+    """
+    Execute statement from the catalog in the session. Returns fetched rows
+    """
+    statement = STATEMENTS[name]
+    connection = session.connection().execution_options(compiled_cache=_compiled_cache)
+    started = time.monotonic()
+    rows = connection.execute(statement, **params).fetchall()
+    elapsed = time.monotonic() - started
+    with _stats_lock:
+        stats = query_stats[name]
+        stats['calls'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+    return rows
+
+def explain(session, name:str, **params):
+    """
+    Returns query plan of the statement
+    """
+    # Statements with typed columns wrap the TextClause
+    sql = getattr(STATEMENTS[name], 'element', STATEMENTS[name]).text
+    prefix = 'EXPLAIN QUERY PLAN ' if session.get_bind().dialect.name == 'sqlite' else 'EXPLAIN '
+    return session.execute(text(prefix + sql), params).fetchall()
+
+def get_query_stats():
+    """
+    Returns timing counters with average per statement
+    """
+    with _stats_lock:
+        stats = {name: dict(values) for name, values in query_stats.items()}
+    for values in stats.values():
+        if values['calls']:
+            values['avg'] = values['total'] / values['calls']
+    return stats
@@ -0,0 +1,80 @@
+from bisect import bisect_left, insort
+from collections import namedtuple
+import threading
+
+
+RankInfo = namedtuple('RankInfo', ['rank', 'points', 'participants', 'above', 'below', 'gap_to_first'])
+RankedUser = namedtuple('RankedUser', ['user_id', 'name', 'points'])
+
+
+class RankIndex:
+    """
+    Scores of one leaderboard as a sorted array of (-points, participant_id).
+
+    Rank of a user, the participants around them and the top N are found with bisect
+    in O(log n). A score change moves one entry (bisect + list insert/delete).
+    Rank is 1 + number of participants with more points, equal points share the rank.
+    """
+
+    def __init__(self, rows):
+        """
+        rows: (participant_id, user_id, name, points)
+        """
+        self._entries = []
+        self._points = {}
+        self._users = {}
+        self._participants = {}
+        self._lock = threading.Lock()
+        for participant_id, user_id, name, points in rows:
+            points = int(points)
+            self._points[participant_id] = points
+            self._users[participant_id] = (user_id, name)
+            self._participants[user_id] = participant_id
+            self._entries.append((-points, participant_id))
+        self._entries.sort()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_points(self, participant_id:int, points:int):
+        """
+        Move participant to new points. Returns False for unknown participants
+        """
+        points = int(points)
+        with self._lock:
+            old = self._points.get(participant_id)
+            if old is None:
+                return False
+            if old != points:
+                del self._entries[bisect_left(self._entries, (-old, participant_id))]
+                insort(self._entries, (-points, participant_id))
+                self._points[participant_id] = points
+            return True
+
+    def rank(self, user_id:int):
+        """
+        Returns RankInfo of the user or None if user is not a participant
+        """
+        with self._lock:
+            participant_id = self._participants.get(user_id)
+            if participant_id is None:
+                return None
+            points = self._points[participant_id]
+            position = bisect_left(self._entries, (-points, participant_id))
+            above = self._ranked(self._entries[position - 1]) if position > 0 else None
+            below = self._ranked(self._entries[position + 1]) if position + 1 < len(self._entries) else None
+            return RankInfo(rank=bisect_left(self._entries, (-points, )) + 1, points=points,
+                            participants=len(self._entries), above=above, below=below,
+                            gap_to_first=-self._entries[0][0] - points)
+
+    def top(self, count:int):
+        """
+        Returns list of RankedUser with most points
+        """
+        with self._lock:
+            return [self._ranked(entry) for entry in self._entries[:count]]
+
+    def _ranked(self, entry):
+        negative_points, participant_id = entry
+        user_id, name = self._users[participant_id]
+        return RankedUser(user_id, name, -negative_points)
@@ -0,0 +1,290 @@
+import asyncio
+import functools
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+from model import in_unit_of_work, after_unit_of_work
+from outbox import QueuedBot
+from scheduler import PeriodicJob
+
+
+logger = logging.getLogger(__name__)
+
+
+class UnitOfWorkRequest(Request):
+    """
+    Holds Telegram requests a handler makes inside its unit of work and sends them in order
+    once the unit of work is committed, so row locks and the db connection are not held
+    during the round trips. Held requests return True instead of the sent Message
+    """
+
+    def post(self, url, data, timeout=None):
+        if not in_unit_of_work():
+            return super().post(url, data, timeout=timeout)
+        after_unit_of_work(functools.partial(super().post, url, data, timeout=timeout))
+        return True
+
+
+class AsyncSendBot(Bot):
+    """
+    Bot that does not block handlers on outgoing requests.
+    Sends are scheduled on the runtime event loop and kept in order per chat
+    """
+
+    def __init__(self, token, runtime, **kwargs):
+        super().__init__(token, **kwargs)
+        self._runtime = runtime
+
+    @staticmethod
+    def _chat_id(args, kwargs):
+        return kwargs.get('chat_id', args[0] if args else None)
+
+    def send_message(self, *args, **kwargs):
+        return self._runtime.send(self._chat_id(args, kwargs), super().send_message, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._runtime.send(kwargs.get('chat_id'), super().edit_message_text, *args, **kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self._runtime.send(kwargs.get('chat_id'), super().edit_message_reply_markup, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._runtime.send(None, super().answer_callback_query, *args, **kwargs)
+
+
+class AsyncioRuntime:
+    """
+    Polls Telegram and dispatches updates on an asyncio event loop.
+
+    Handlers stay synchronous and run in a bounded thread pool, so blocking db calls
+    never use more than `workers` threads. Size `workers` to the db connection pool.
+    Updates of one chat are handled one at a time in order (conversation states stay consistent),
+    different chats in parallel. An update waiting for an earlier one of its chat holds no thread.
+    Polling stops while `max_pending` updates are waiting or running.
+    Replies are sent concurrently by a separate pool of `send_concurrency` threads,
+    or by `outbox` when given.
+    """
+
+    def __init__(self, token:str, workers:int=32, send_concurrency:int=16, poll_timeout:int=10, persistence=None,
+                 outbox=None, max_pending:int=None):
+        self.workers = workers
+        self.max_pending = max_pending or workers * 8
+        self.send_concurrency = send_concurrency
+        self.poll_timeout = poll_timeout
+
+        # One HTTP connection per thread that may talk to Telegram
+        request = UnitOfWorkRequest(con_pool_size=workers + send_concurrency + 1, read_timeout=poll_timeout + 5)
+        if outbox is not None:
+            self.bot = QueuedBot(token, outbox, request=request)
+        else:
+            self.bot = AsyncSendBot(token, runtime=self, request=request)
+        self.dispatcher = Dispatcher(self.bot, Queue(), workers=0, use_context=True, persistence=persistence)
+
+        self._handlers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self._senders = ThreadPoolExecutor(max_workers=send_concurrency, thread_name_prefix='sender')
+        self._poller = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poller')
+        self._loop = None
+        self._running = False
+        # Last scheduled send per chat
+        self._tails = {}
+        # Last scheduled update per chat
+        self._update_tails = {}
+        self._pending = set()
+
+        self.stats = {'updates': 0, 'pending': 0, 'in_flight': 0, 'sent': 0, 'send_errors': 0}
+
+    def run(self):
+        """
+        Run until SIGINT/SIGTERM
+        """
+        asyncio.run(self._main())
+
+    def stop(self):
+        self._running = False
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._backlog = asyncio.Semaphore(self.max_pending)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        self._running = True
+        await self._loop.run_in_executor(self._poller, self.bot.delete_webhook)
+        try:
+            await self._poll()
+        finally:
+            # Let waiting and in-flight handlers and their replies finish
+            for _ in range(self.max_pending):
+                await self._backlog.acquire()
+            # Sends scheduled by the last handlers
+            await asyncio.sleep(0)
+            if self._pending:
+                await asyncio.wait(self._pending)
+            self._handlers.shutdown()
+            self._senders.shutdown()
+            self._poller.shutdown()
+            logger.info(f'Asyncio runtime stopped. {self.stats}')
+
+    async def _poll(self):
+        offset = None
+        while self._running:
+            try:
+                updates = await self._loop.run_in_executor(
+                    self._poller,
+                    lambda: self.bot.get_updates(offset=offset, timeout=self.poll_timeout)
+                )
+            except TelegramError as e:
+                logger.warning(f'Polling failed: {e}')
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                # Backpressure: wait until fewer than max_pending updates are unfinished
+                await self._backlog.acquire()
+                self._track(asyncio.ensure_future(self._handle(update)))
+
+    async def _handle(self, update):
+        self.stats['updates'] += 1
+        self.stats['pending'] += 1
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        previous = self._update_tails.get(chat_id) if chat_id is not None else None
+        done = self._loop.create_future()
+        if chat_id is not None:
+            self._update_tails[chat_id] = done
+        try:
+            if previous is not None:
+                await previous
+            # Handler thread is taken only when the update can run
+            async with self._slots:
+                self.stats['in_flight'] += 1
+                try:
+                    await self._loop.run_in_executor(self._handlers, self.dispatcher.process_update, update)
+                finally:
+                    self.stats['in_flight'] -= 1
+        finally:
+            done.set_result(None)
+            if self._update_tails.get(chat_id) is done:
+                del self._update_tails[chat_id]
+            self.stats['pending'] -= 1
+            self._backlog.release()
+
+    def send(self, chat_id, method, *args, **kwargs):
+        """
+        Schedule Telegram request from a handler thread. Returns concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(self._send(chat_id, method, args, kwargs), self._loop)
+
+    async def _send(self, chat_id, method, args, kwargs):
+        previous = self._tails.get(chat_id) if chat_id is not None else None
+        done = self._loop.create_future()
+        if chat_id is not None:
+            self._tails[chat_id] = done
+        self._track(done)
+        try:
+            if previous is not None:
+                await previous
+            result = await self._loop.run_in_executor(self._senders, lambda: method(*args, **kwargs))
+            self.stats['sent'] += 1
+            return result
+        except TelegramError as e:
+            self.stats['send_errors'] += 1
+            logger.warning(f'Sending to chat {chat_id} failed: {e}')
+        finally:
+            done.set_result(None)
+            if self._tails.get(chat_id) is done:
+                del self._tails[chat_id]
+
+    def _track(self, future):
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+
+class ShardedDispatcher(Dispatcher):
+    """
+    Dispatcher that hashes effective_chat.id to one of `shards` worker threads.
+    Updates of one chat are processed in order (conversation states stay consistent),
+    different chats are processed in parallel.
+
+    Each shard has a bounded queue of `queue_depth` updates. When a shard is full
+    the dispatcher thread blocks, so the unprocessed updates wait in update_queue.
+    Shard stats are logged every `stats_interval` seconds (0 disables) and on stop.
+    """
+
+    def __init__(self, bot, update_queue, shards:int=8, queue_depth:int=100, stats_interval:float=60, **kwargs):
+        # Shards replace the run_async worker pool
+        kwargs.setdefault('workers', 0)
+        super().__init__(bot, update_queue, **kwargs)
+        self._shards = [Queue(maxsize=queue_depth) for _ in range(shards)]
+        self._shard_threads = []
+        self._shard_stats = [{'processed': 0, 'lag_last': 0.0, 'lag_max': 0.0} for _ in range(shards)]
+        self._stats_job = None
+        if stats_interval > 0:
+            self._stats_job = PeriodicJob('shard_stats', stats_interval, self._log_stats, delay=stats_interval)
+
+    def start(self, ready=None):
+        for index, shard in enumerate(self._shards):
+            thread = threading.Thread(target=self._run_shard, args=(index, ), name=f'shard_{index}', daemon=True)
+            thread.start()
+            self._shard_threads.append(thread)
+        if self._stats_job:
+            self._stats_job.start()
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        for shard in self._shards:
+            shard.put(None)
+        for thread in self._shard_threads:
+            thread.join()
+        self._shard_threads = []
+        if self._stats_job:
+            self._stats_job.stop()
+        logger.info(f'Sharded dispatcher stopped. {self.shard_stats()}')
+
+    def process_update(self, update):
+        """
+        Called by the dispatcher thread. Puts update to the shard of its chat
+        """
+        chat = update.effective_chat if isinstance(update, Update) else None
+        index = hash(chat.id if chat else 0) % len(self._shards)
+        self._shards[index].put((time.monotonic(), update))
+
+    def _run_shard(self, index:int):
+        shard = self._shards[index]
+        stats = self._shard_stats[index]
+        while True:
+            item = shard.get()
+            if item is None:
+                break
+            queued, update = item
+            lag = time.monotonic() - queued
+            stats['lag_last'] = lag
+            stats['lag_max'] = max(stats['lag_max'], lag)
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception(f'Shard {index} failed to process update')
+            stats['processed'] += 1
+
+    def shard_stats(self):
+        """
+        Returns queue depth, processed updates and lag (seconds in queue) per shard
+        """
+        return [dict(stats, depth=shard.qsize()) for shard, stats in zip(self._shards, self._shard_stats)]
+
+    def _log_stats(self):
+        logger.info(f'Shards: {self.shard_stats()}')
@@ -0,0 +1,49 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """
+    Runs func() every `interval` seconds in a background thread.
+    The first run is `delay` seconds after start. Failures are logged, the job keeps running
+    """
+
+    def __init__(self, name:str, interval:float, func, delay:float=0):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.delay = delay
+        self.stats = {'runs': 0, 'failures': 0, 'last_duration': 0.0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop after the running call returns
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        wait = self.delay
+        while not self._stop.wait(wait):
+            started = time.monotonic()
+            try:
+                result = self.func()
+                if result is not None:
+                    logger.info(f'{self.name}: {result}')
+            except Exception:
+                self.stats['failures'] += 1
+                logger.exception(f'{self.name} failed')
+            self.stats['runs'] += 1
+            self.stats['last_duration'] = time.monotonic() - started
+            wait = self.interval
@@ -0,0 +1,20 @@
+-- Migration for databases created before week/month scores.
+-- New databases get these from init_db().
+-- daily_executions is filled from history by init_db() on the next start
+
+ALTER TABLE `leaderboard`.`leaderboards`
+    ADD COLUMN timezone VARCHAR(64) NULL;
+
+CREATE TABLE `leaderboard`.`daily_executions` (
+    participant_id BIGINT NOT NULL,
+    day DATE NOT NULL,
+    activity_id BIGINT NOT NULL,
+    leaderboard_id BIGINT NULL,
+    executions INT NOT NULL,
+    PRIMARY KEY (participant_id, day, activity_id),
+    KEY ix_daily_executions_activity_id (activity_id),
+    KEY ix_daily_executions_leaderboard_id (leaderboard_id),
+    FOREIGN KEY (participant_id) REFERENCES `leaderboard`.`participants` (id) ON DELETE CASCADE,
+    FOREIGN KEY (activity_id) REFERENCES `leaderboard`.`activities` (id) ON DELETE CASCADE,
+    FOREIGN KEY (leaderboard_id) REFERENCES `leaderboard`.`leaderboards` (id)
+);
@@ -0,0 +1,14 @@
+-- Migration for databases created before ON DELETE CASCADE foreign keys.
+-- New databases get these from init_db().
+-- Constraint names below are the ones MySQL generates for unnamed foreign keys,
+-- check them with SHOW CREATE TABLE before running.
+
+ALTER TABLE `leaderboard`.`performed_activity`
+    DROP FOREIGN KEY performed_activity_ibfk_1,
+    DROP FOREIGN KEY performed_activity_ibfk_2;
+
+ALTER TABLE `leaderboard`.`performed_activity`
+    ADD CONSTRAINT performed_activity_ibfk_1
+        FOREIGN KEY (activity_id) REFERENCES `leaderboard`.`activities` (id) ON DELETE CASCADE,
+    ADD CONSTRAINT performed_activity_ibfk_2
+        FOREIGN KEY (participant_id) REFERENCES `leaderboard`.`participants` (id) ON DELETE CASCADE;
@@ -0,0 +1,48 @@
+-- Migration for databases created before performed_activity.leaderboard_id.
+-- New databases get these from init_db()
+
+ALTER TABLE `leaderboard`.`performed_activity`
+    ADD COLUMN leaderboard_id BIGINT NULL,
+    ADD CONSTRAINT performed_activity_leaderboard_fk
+        FOREIGN KEY (leaderboard_id) REFERENCES `leaderboard`.`leaderboards` (id);
+
+UPDATE `leaderboard`.`performed_activity` pa
+JOIN `leaderboard`.`activities` a
+    ON a.id = pa.activity_id
+SET pa.leaderboard_id = a.leaderboard_id;
+
+CREATE INDEX ix_performed_activity_participant_time
+    ON `leaderboard`.`performed_activity` (participant_id, time_created);
+CREATE INDEX ix_performed_activity_leaderboard_time
+    ON `leaderboard`.`performed_activity` (leaderboard_id, time_created);
+
+-- Participants used to be created with check-then-insert, which could race.
+-- Keep the first participant of each (leaderboard_id, user_id) and move executions of the others to it.
+-- If participant_scores already exists, delete its rows of the removed participants first
+-- (same join as the DELETE below) and run `python manage.py scores rebuild` afterwards.
+UPDATE `leaderboard`.`performed_activity` pa
+JOIN `leaderboard`.`participants` p
+    ON p.id = pa.participant_id
+JOIN (
+    SELECT leaderboard_id, user_id, MIN(id) AS keep_id
+    FROM `leaderboard`.`participants`
+    GROUP BY leaderboard_id, user_id
+    HAVING COUNT(*) > 1
+) d
+    ON d.leaderboard_id = p.leaderboard_id AND d.user_id = p.user_id
+SET pa.participant_id = d.keep_id
+WHERE pa.participant_id <> d.keep_id;
+
+DELETE p
+FROM `leaderboard`.`participants` p
+JOIN (
+    SELECT leaderboard_id, user_id, MIN(id) AS keep_id
+    FROM `leaderboard`.`participants`
+    GROUP BY leaderboard_id, user_id
+    HAVING COUNT(*) > 1
+) d
+    ON d.leaderboard_id = p.leaderboard_id AND d.user_id = p.user_id
+WHERE p.id <> d.keep_id;
+
+ALTER TABLE `leaderboard`.`participants`
+    ADD UNIQUE KEY (leaderboard_id, user_id);
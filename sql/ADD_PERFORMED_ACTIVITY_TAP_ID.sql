@@ -0,0 +1,6 @@
+-- Migration for databases created before performed_activity.tap_id (write-behind journal).
+-- New databases get it from init_db()
+
+ALTER TABLE `leaderboard`.`performed_activity`
+    ADD COLUMN tap_id VARCHAR(32) NULL,
+    ADD UNIQUE KEY (tap_id);
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+# model reads the database URL at import
+_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+os.environ['DB_URL'] = f'sqlite:///{_db.name}'
+
+import model
+from journal import WriteBehindJournal
+
+
+def _count(sql:str):
+    with model.session_scope() as session:
+        return session.execute(sql).scalar()
+
+
+class WriteBehindJournalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        model.init_db()
+        model.onboard(leaderboard_id=1, leaderboard_name='chat', user_id=5, user_name='u')
+        activity = model.Activity('a', 3, 5, 1)
+        cls.activity_id = activity.save_activity()
+
+    def setUp(self):
+        with model.session_scope() as session:
+            session.execute('DELETE FROM performed_activity')
+        self.path = tempfile.mktemp(suffix='.journal')
+        self.addCleanup(lambda: [os.remove(path) for path in (self.path, self.path + '.dead') if os.path.exists(path)])
+
+    def _lines(self, path=None):
+        with open(path or self.path, encoding='utf-8') as f:
+            return len(f.readlines())
+
+    def test_flush_inside_failed_unit_of_work_keeps_taps(self):
+        journal = WriteBehindJournal(self.path)
+        journal.record(user_id=5, leaderboard_id=1, activity_id=self.activity_id, points=3)
+        with self.assertRaises(RuntimeError):
+            with model.session_scope():
+                journal.flush()
+                raise RuntimeError('reply failed')
+        # Saved in its own transaction, the handler rollback does not undo it
+        self.assertEqual(_count('SELECT COUNT(*) FROM performed_activity'), 1)
+        self.assertEqual(self._lines(), 0)
+
+    def test_replay_saves_each_tap_once(self):
+        journal = WriteBehindJournal(self.path)
+        journal.record(user_id=5, leaderboard_id=1, activity_id=self.activity_id, points=3)
+        journal.record(user_id=5, leaderboard_id=1, activity_id=self.activity_id, points=3)
+        # Crash after the first tap was saved, before the journal was rewritten
+        model.save_taps(taps=[journal._tap(journal._entries[0])])
+
+        replayed = WriteBehindJournal(self.path)
+        self.assertEqual(len(replayed._entries), 2)
+        replayed.flush()
+        self.assertEqual(_count('SELECT COUNT(*) FROM performed_activity'), 2)
+        self.assertEqual(replayed.stats['skipped'], 1)
+        self.assertEqual(self._lines(), 0)
+
+    def test_tap_of_user_without_start_is_saved(self):
+        journal = WriteBehindJournal(self.path)
+        journal.record(user_id=7, leaderboard_id=1, activity_id=self.activity_id, points=3, user_name='new')
+        journal.flush()
+        self.assertEqual(_count('SELECT COUNT(*) FROM performed_activity'), 1)
+        self.assertEqual(_count("SELECT name FROM users WHERE id = 7"), 'new')
+
+    def test_rejected_tap_goes_to_dead_letter_file(self):
+        journal = WriteBehindJournal(self.path)
+        journal.record(user_id=5, leaderboard_id=1, activity_id=self.activity_id, points=3)
+        journal.record(user_id=5, leaderboard_id=1, activity_id=self.activity_id, points=3)
+        # Corrupt tap behind a valid one
+        journal._entries[1]['time_created'] = 'not a time'
+        journal.flush()
+        self.assertEqual(_count('SELECT COUNT(*) FROM performed_activity'), 1)
+        self.assertEqual(self._lines(self.path + '.dead'), 1)
+        self.assertEqual(self._lines(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()